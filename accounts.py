@@ -0,0 +1,21 @@
+import json
+import os
+
+
+def load_accounts():
+    '''
+    Accounts come from the json file at ACCOUNTS_FILE:
+    [
+        {"username": "someone@example.com", "password": "..."},
+        {"username": "someone.else@example.com", "password": "..."}
+    ]
+    or, when it is not set, from GARMIN_USERNAME and GARMIN_PASSWORD.
+    '''
+    path = os.environ.get('ACCOUNTS_FILE')
+    if not path:
+        return [{
+            'username': os.environ.get('GARMIN_USERNAME'),
+            'password': os.environ.get('GARMIN_PASSWORD'),
+        }]
+    with open(path) as f:
+        return json.load(f)
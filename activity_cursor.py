@@ -0,0 +1,28 @@
+class ActivityCursor():
+    '''
+    Persisted high-water mark of the newest activity already processed
+    for one user, so the next run only pages back as far as it has to.
+    '''
+    def __init__(self, store, user):
+        self.store = store
+        self.key = 'activities:{}'.format(user)
+        mark = store.get(self.key) or {}
+        self.since = mark.get('activityId')
+        self.newest = None
+
+    def track(self, activities):
+        for activity in activities:
+            if self.newest is None or activity['activityId'] > self.newest['activityId']:
+                self.newest = activity
+            yield activity
+
+    def commit(self):
+        if self.newest is None:
+            return
+        if self.since is not None and self.newest['activityId'] <= self.since:
+            return
+        self.store.set(self.key, {
+            'activityId': self.newest['activityId'],
+            'beginTimestamp': self.newest['beginTimestamp'],
+        })
+        self.store.save()
@@ -0,0 +1,217 @@
+import importlib.util
+import os
+import struct
+import threading
+import traceback
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fit import FitError, read_records
+from metric_specs import QUANTILES
+from startup import lazy_import
+from state_store import state_path
+
+# samples further apart than this are a pause, not time spent moving
+MAX_GAP = 30
+# slower than this, in meters per second, counts as standing still
+MOVING_SPEED = 0.5
+# heart rate zones 1 to 5 start at these fractions of the maximum heart rate
+ZONES = (0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+def weighted_quantiles(np, values, weights, quantiles):
+    order = np.argsort(values)
+    values = values[order]
+    cumulative = np.cumsum(weights[order])
+    if not len(values) or cumulative[-1] <= 0:
+        return None
+    # the value below which a given share of the weight falls
+    return np.interp(np.asarray(quantiles) * cumulative[-1], cumulative, values)
+
+
+def rolling_mean(np, values, window):
+    cumulative = np.cumsum(np.insert(values, 0, 0.0))
+    return (cumulative[window:] - cumulative[:-window]) / window
+
+
+def analyze(columns, heart_rate_max):
+    '''
+    Per-activity analytics from the record columns of a FIT file, as a
+    flat dict keyed like the ACTIVITY metric specs. Every sample counts
+    for the time until the next one, so smart recording (samples only on
+    changes) weighs right. Keys without data, like power on a run without
+    a power meter, are left out.
+    '''
+    np = lazy_import('numpy')
+    timestamps = np.frombuffer(columns['timestamp'], dtype=np.float64)
+    keep = ~np.isnan(timestamps)
+    timestamps = timestamps[keep]
+    if len(timestamps) < 2:
+        return {}
+    column = {name: np.frombuffer(values, dtype=np.float64)[keep]
+              for name, values in columns.items()}
+    order = np.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+    column = {name: values[order] for name, values in column.items()}
+
+    seconds = np.diff(timestamps, append=timestamps[-1])
+    seconds[seconds > MAX_GAP] = 0
+    speed = column['speed']
+    moving = speed >= MOVING_SPEED
+    has_speed = ~np.isnan(speed)
+    result = {
+        'elapsedSeconds': timestamps[-1] - timestamps[0],
+        'movingSeconds': seconds[moving].sum() if has_speed.any() else seconds.sum(),
+    }
+
+    heart_rate = column['heart_rate']
+    valid = ~np.isnan(heart_rate)
+    if seconds[valid].sum() > 0:
+        result['averageHeartRate'] = np.average(heart_rate[valid], weights=seconds[valid])
+        bounds = np.asarray(ZONES) * heart_rate_max
+        # 0 below zone 1, 5 for zone 5 and above
+        zones = np.digitize(heart_rate[valid], bounds)
+        per_zone = np.bincount(zones, weights=seconds[valid], minlength=len(ZONES) + 1)
+        for zone in range(1, len(ZONES) + 1):
+            result['heartRateZone{}Seconds'.format(zone)] = per_zone[zone]
+
+    cadence = column['cadence']
+    valid = ~np.isnan(cadence) & (moving | ~has_speed)
+    if seconds[valid].sum() > 0:
+        result['averageCadence'] = np.average(cadence[valid], weights=seconds[valid])
+
+    if moving.any():
+        pace = 1000.0 / speed[moving]
+        quantiles = weighted_quantiles(np, pace, seconds[moving], [float(q) for q in QUANTILES])
+        if quantiles is not None:
+            result.update(('pace:' + q, value) for q, value in zip(QUANTILES, quantiles))
+
+    power = column['power']
+    valid = ~np.isnan(power)
+    if seconds[valid].sum() > 0:
+        result['averagePower'] = np.average(power[valid], weights=seconds[valid])
+        quantiles = weighted_quantiles(np, power[valid], seconds[valid],
+                                       [float(q) for q in QUANTILES])
+        result.update(('power:' + q, value) for q, value in zip(QUANTILES, quantiles))
+        # 30 second rolling average on a 1 second grid, then the 4th power mean
+        grid = np.arange(timestamps[valid][0], timestamps[valid][-1] + 1)
+        if len(grid) >= 30:
+            rolling = rolling_mean(np, np.interp(grid, timestamps[valid], power[valid]), 30)
+            result['normalizedPower'] = np.mean(rolling ** 4) ** 0.25
+
+    altitude = column['altitude']
+    valid = ~np.isnan(altitude)
+    if valid.sum() >= 5:
+        # smoothed over 5 samples, so barometer noise does not add up
+        climbs = np.diff(rolling_mean(np, altitude[valid], 5))
+        result['elevationGain'] = climbs[climbs > 0].sum()
+        result['elevationLoss'] = -climbs[climbs < 0].sum()
+
+    return {key: round(float(value), 3) for key, value in result.items()}
+
+
+class ActivityFiles():
+    '''
+    Original FIT files of new activities, downloaded in parallel while the
+    activity list streams in, kept under ACTIVITY_FILES_DIR and turned into
+    per-activity analytics: time in heart rate zones, pace and power
+    distributions, normalized power and elevation gain. The analytics are
+    archived by activity id, so a file is never downloaded or parsed twice,
+    and the newest ACTIVITY_FILES_EXPORT activities of each user are
+    exported as metrics.
+    '''
+    def __init__(self, logger, archive):
+        self.logger = logger
+        self.archive = archive
+        self.enabled = os.environ.get('ACTIVITY_FILES', 'false').lower() == 'true'
+        self.directory = os.environ.get('ACTIVITY_FILES_DIR') or state_path('activities')
+        self.export = int(os.environ.get('ACTIVITY_FILES_EXPORT', '10'))
+        self.heart_rate_max = int(os.environ.get('HEART_RATE_MAX', '190'))
+        self.concurrency = int(os.environ.get('FETCH_CONCURRENCY', '4'))
+        # only looked up, numpy is imported by the first analysis
+        if self.enabled and importlib.util.find_spec('numpy') is None:
+            self.logger.error('ACTIVITY_FILES needs numpy, which is not installed '
+                              '(pip install numpy), activity files are not downloaded')
+            self.enabled = False
+        self.lock = threading.Lock()
+        self.pool = None
+        self.futures = {}
+
+    def track(self, connect, activities):
+        '''
+        Pass activities through, starting the download and analysis of
+        each one that was not processed before
+        '''
+        for activity in activities:
+            if self.enabled:
+                self.submit(connect, activity)
+            yield activity
+
+    def submit(self, connect, activity):
+        user = connect.display_name
+        key = (user, activity['activityId'])
+        with self.lock:
+            if key in self.futures:
+                return
+            if self.archive.lookup(user, 'activity_file', str(activity['activityId'])):
+                return
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+            self.futures[key] = (self.pool.submit(self.process, connect, activity), activity)
+
+    def process(self, connect, activity):
+        activity_id = activity['activityId']
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.zip'.format(activity_id))
+        if not os.path.exists(path):
+            try:
+                connect.download_activity(activity_id, path)
+            except lazy_import('requests').exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                # manual entries have no file, remember that they have none
+                self.logger.info('Activity {} has no FIT file'.format(activity_id))
+                return {}
+        try:
+            records = read_records(path)
+        except (FitError, struct.error, zipfile.BadZipFile):
+            # a broken file stays broken, it is not downloaded again
+            self.logger.error('Cannot parse {}: {}'.format(path, traceback.format_exc()))
+            return {}
+        return analyze(records, self.heart_rate_max)
+
+    def finish(self, connects):
+        '''
+        Wait for this run's downloads, archive their analytics and return
+        {user: analytics of the newest activities} for the given accounts
+        '''
+        if not self.enabled:
+            return {}
+        with self.lock:
+            futures, self.futures = self.futures, {}
+            pool, self.pool = self.pool, None
+        for (user, activity_id), (future, activity) in futures.items():
+            try:
+                metrics = future.result()
+            except Exception:
+                # not archived, so it is tried again while it is on the first page
+                self.logger.error(traceback.format_exc())
+                continue
+            date = (activity.get('startTimeLocal') or activity.get('startTimeGMT') or '')[:10]
+            self.archive.payload(user, 'activity_file', date, {
+                'id': activity_id,
+                'type': (activity.get('activityType') or {}).get('typeKey', 'other'),
+                'metrics': metrics,
+            }, key=str(activity_id))
+        if pool is not None:
+            pool.shutdown()
+        if futures:
+            self.logger.info('Analyzed {} activity files'.format(len(futures)))
+        exported = {}
+        for connect in connects:
+            user = connect.display_name
+            # activities without a file are archived too, with no metrics
+            latest = self.archive.latest(user, 'activity_file', self.export * 2)
+            exported[user] = [entry for entry in latest if entry['metrics']][:self.export]
+        return exported
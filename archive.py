@@ -0,0 +1,289 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from startup import lazy_import
+from state_store import state_path
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS payloads (
+    user TEXT NOT NULL,
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    date TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (user, source, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS payloads_date ON payloads (user, source, date);
+CREATE TABLE IF NOT EXISTS rollups (
+    user TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    period TEXT NOT NULL,
+    start TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (user, metric, period, start, labels)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS rollups_metric ON rollups (metric, period, start);
+CREATE TABLE IF NOT EXISTS sleep_timelines (
+    user TEXT NOT NULL,
+    date TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    timeline BLOB NOT NULL,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS intraday_held (
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    timestamps BLOB NOT NULL,
+    samples BLOB NOT NULL,
+    PRIMARY KEY (user, name, start)
+) WITHOUT ROWID;
+'''
+
+PERIODS = ('day', 'week', 'month')
+
+
+def period_start(date, period):
+    '''
+    First day of the week (monday) or month holding a YYYY-MM-DD date
+    '''
+    day = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    if period == 'week':
+        day -= datetime.timedelta(days=day.weekday())
+    elif period == 'month':
+        day = day.replace(day=1)
+    return day.strftime('%Y-%m-%d')
+
+
+def period_end(start, period):
+    day = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    if period == 'week':
+        day += datetime.timedelta(days=6)
+    elif period == 'month':
+        following = (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        day = following - datetime.timedelta(days=1)
+    return day.strftime('%Y-%m-%d')
+
+
+def label_key(labels):
+    return json.dumps({k: v for k, v in labels.items() if k != 'user'}, sort_keys=True)
+
+
+class Archive():
+    '''
+    Local long-term store in SQLite, next to Prometheus' short retention:
+    every downloaded payload as it came from garmin connect, and every
+    metric as count/sum/min/max rollups per day, week and month, keyed on
+    user, metric and date. A daily metric is one sample per day; intraday
+    series are folded into the day they were recorded on.
+    '''
+    def __init__(self, logger, path=None):
+        self.logger = logger
+        self.path = path or os.environ.get('ARCHIVE_PATH') or state_path('archive.db')
+        self.timezone = os.environ.get('TIMEZONE', 'UTC')
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # readers, like the query command, do not block a running collector
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def payload(self, user, source, date, data, key=None):
+        if not data:
+            return
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO payloads VALUES (?, ?, ?, ?, ?, ?)',
+                (user, source, key or date, date, time.time(), json.dumps(data)))
+
+    def lookup(self, user, source, key):
+        '''
+        An archived payload, or None
+        '''
+        with self.lock:
+            row = self.db.execute(
+                'SELECT payload FROM payloads WHERE user = ? AND source = ? AND key = ?',
+                (user, source, key)).fetchone()
+        return json.loads(row['payload']) if row else None
+
+    def latest(self, user, source, limit):
+        '''
+        The newest archived payloads of a source, newest first
+        '''
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT payload FROM payloads WHERE user = ? AND source = ? '
+                'ORDER BY date DESC, key DESC LIMIT ?', (user, source, limit)).fetchall()
+        return [json.loads(row['payload']) for row in rows]
+
+    def activities(self, user, activities):
+        '''
+        Pass activities through, archiving each one on the way
+        '''
+        for activity in activities:
+            date = (activity.get('startTimeLocal') or '')[:10]
+            self.payload(user, 'activity', date, activity, key=str(activity['activityId']))
+            yield activity
+
+    def daily(self, user, date, samples):
+        '''
+        Record (metric, labels, value) samples of one day. They replace what
+        was archived for that day before, a later download of the same day
+        is the more complete one.
+        '''
+        samples = list(samples)
+        if not samples:
+            return
+        with self.lock, self.db:
+            for metric, labels, value in samples:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?)',
+                    (user, metric, label_key(labels), 'day', date, value, value, value))
+            for metric, labels, _ in samples:
+                self.rollup(user, metric, label_key(labels), date)
+
+    def series(self, user, metric, timestamps, values, labels={}):
+        '''
+        Fold new intraday samples into the rollups of their local day. The
+        caller only passes samples that were not archived before.
+        '''
+        tz = lazy_import('pytz').timezone(self.timezone)
+        days = {}
+        for timestamp, value in zip(timestamps, values):
+            utc = datetime.datetime.utcfromtimestamp(timestamp / 1000.0)
+            date = tz.fromutc(utc).strftime('%Y-%m-%d')
+            count, total, low, high = days.get(date, (0, 0.0, value, value))
+            days[date] = (count + 1, total + value, min(low, value), max(high, value))
+        if not days:
+            return
+        labels = label_key(labels)
+        with self.lock, self.db:
+            for date, (count, total, low, high) in days.items():
+                self.db.execute(
+                    'INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (user, metric, period, start, labels) DO UPDATE SET '
+                    'count = count + excluded.count, sum = sum + excluded.sum, '
+                    'min = MIN(min, excluded.min), max = MAX(max, excluded.max)',
+                    (user, metric, labels, 'day', date, count, total, low, high))
+                self.rollup(user, metric, labels, date)
+
+    def timeline(self, user, date, start, timeline):
+        '''
+        Store the packed sleep timeline of one night, see sleep_timeline.py.
+        A night is stored once, returns False when it already was.
+        '''
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO sleep_timelines (user, date, start, timeline) '
+                'VALUES (?, ?, ?, ?)', (user, date, start, timeline))
+        return cursor.rowcount > 0
+
+    def has_timeline(self, user, date):
+        with self.lock:
+            return self.db.execute(
+                'SELECT 1 FROM sleep_timelines WHERE user = ? AND date = ?',
+                (user, date)).fetchone() is not None
+
+    def timelines(self, user=None, start=None, end=None, delivered=None):
+        '''
+        Packed sleep timelines as (user, date, start, timeline) rows, oldest
+        first
+        '''
+        sql = 'SELECT user, date, start, timeline FROM sleep_timelines WHERE 1'
+        args = []
+        for clause, value in (('user = ?', user), ('date >= ?', start), ('date <= ?', end),
+                              ('delivered = ?', delivered)):
+            if value is not None:
+                sql += ' AND ' + clause
+                args.append(value)
+        sql += ' ORDER BY date, user'
+        with self.lock:
+            return [tuple(row) for row in self.db.execute(sql, args).fetchall()]
+
+    def delivered_timelines(self, keys):
+        '''
+        Mark (user, date) sleep timelines as written to the sinks
+        '''
+        with self.lock, self.db:
+            self.db.executemany(
+                'UPDATE sleep_timelines SET delivered = 1 WHERE user = ? AND date = ?', keys)
+
+    def hold_series(self, user, name, start, timestamps, values):
+        '''
+        Keep packed intraday samples that had nowhere to be written yet,
+        see intraday.py
+        '''
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO intraday_held VALUES (?, ?, ?, ?, ?)',
+                            (user, name, start, timestamps, values))
+
+    def held_series(self):
+        '''
+        Held intraday samples as (user, name, start, timestamps, values)
+        rows, oldest first
+        '''
+        with self.lock:
+            return [tuple(row) for row in self.db.execute(
+                'SELECT user, name, start, timestamps, samples FROM intraday_held '
+                'ORDER BY start, user, name').fetchall()]
+
+    def release_series(self, keys):
+        '''
+        Drop (user, name, start) held intraday samples once they are written
+        '''
+        with self.lock, self.db:
+            self.db.executemany(
+                'DELETE FROM intraday_held WHERE user = ? AND name = ? AND start = ?', keys)
+
+    def rollup(self, user, metric, labels, date):
+        # weeks and months are rebuilt from their days, so replacing or
+        # extending a day never counts anything twice
+        for period in ('week', 'month'):
+            start = period_start(date, period)
+            self.db.execute(
+                'INSERT OR REPLACE INTO rollups '
+                'SELECT user, metric, labels, ?, ?, SUM(count), SUM(sum), MIN(min), MAX(max) '
+                'FROM rollups WHERE user = ? AND metric = ? AND labels = ? AND period = ? '
+                'AND start BETWEEN ? AND ? GROUP BY user, metric, labels',
+                (period, start, user, metric, labels, 'day', start, period_end(start, period)))
+
+    def query(self, metric, user=None, period='day', start=None, end=None):
+        '''
+        Rollup rows of a metric, oldest first, as dicts with user, labels,
+        start, count, sum, min, max and avg
+        '''
+        sql = 'SELECT * FROM rollups WHERE metric = ? AND period = ?'
+        args = [metric, period]
+        if user is not None:
+            sql += ' AND user = ?'
+            args.append(user)
+        if start is not None:
+            sql += ' AND start >= ?'
+            args.append(period_start(start, period))
+        if end is not None:
+            sql += ' AND start <= ?'
+            args.append(end)
+        sql += ' ORDER BY start, user, labels'
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [dict(row, labels=json.loads(row['labels']), avg=row['sum'] / row['count'])
+                for row in rows]
+
+    def metrics(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT DISTINCT metric FROM rollups WHERE period = 'month' ORDER BY metric")]
@@ -0,0 +1,142 @@
+import datetime
+import json
+import os
+
+from fetcher import Fetcher
+from prometheus_metrics import PrometheusMetrics
+from samples import SampleBatch, write_openmetrics
+from startup import lazy_import
+from state_store import state_path
+
+
+class Backfill():
+    sources = ('summary', 'weight', 'sleep')
+
+    def __init__(self, logger, connects, start, end, workers=4, rate=None, output=None,
+                 archive=None):
+        self.logger = logger
+        self.archive = archive
+        self.connects = connects
+        self.start = start
+        self.end = end
+        self.timezone = os.environ.get('TIMEZONE', 'UTC')
+        # every request goes through the accounts' shared scheduler, so the
+        # rate is set there, a spacing of our own could only be slower
+        if rate is not None:
+            for scheduler in {connect.scheduler for connect in connects}:
+                scheduler.set_rate(rate)
+        self.fetcher = Fetcher(logger, concurrency=workers, spacing=0)
+        name = 'backfill-{}-{}'.format(start, end)
+        self.checkpoint = state_path(name + '.jsonl')
+        self.output = output or state_path(name + '.om')
+        # one set of metric families for the whole run, emptied after every
+        # account and date
+        self.metrics = PrometheusMetrics(logger)
+
+    def dates(self):
+        day = datetime.datetime.strptime(self.start, '%Y-%m-%d').date()
+        last = datetime.datetime.strptime(self.end, '%Y-%m-%d').date()
+        while day <= last:
+            yield day.strftime('%Y-%m-%d')
+            day += datetime.timedelta(days=1)
+
+    def timestamp(self, date):
+        '''
+        Daily values are stamped at the end of their local calendar day,
+        or now for today, in milliseconds since epoch
+        '''
+        pytz = lazy_import('pytz')
+        tz = pytz.timezone(self.timezone)
+        day = datetime.datetime.strptime(date, '%Y-%m-%d')
+        end_of_day = tz.localize(day.replace(hour=23, minute=59, second=59))
+        now = datetime.datetime.now(pytz.utc)
+        return int(min(end_of_day, now).timestamp() * 1000)
+
+    def load_checkpoint(self):
+        '''
+        One json line per finished account and date:
+        {"user": "...", "date": "2019-01-28",
+         "samples": [[name, documentation, type, labels, value, timestamp], ...]}
+        '''
+        done = {}
+        try:
+            with open(self.checkpoint) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line can be cut short by an interrupted run
+                        continue
+                    done[(entry['user'], entry['date'])] = entry['samples']
+        except OSError:
+            pass
+        return done
+
+    def save_checkpoint(self, user, date, batch):
+        samples = []
+        for name, family in batch.families.items():
+            for labels, value, timestamp in family['samples']:
+                samples.append([name, family['documentation'], family['type'],
+                                labels, value, timestamp])
+        with open(self.checkpoint, 'a') as f:
+            f.write(json.dumps({'user': user, 'date': date, 'samples': samples}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def build(self, user, date, payloads):
+        metrics = self.metrics
+        try:
+            metrics.summary(payloads['summary'], user)
+            metrics.weight(payloads['weight'], user)
+            metrics.sleep(payloads['sleep'], user)
+            if self.archive is not None:
+                for source in self.sources:
+                    self.archive.payload(user, source, date, payloads[source])
+                    self.archive.daily(user, date, metrics.values(source, user))
+            batch = SampleBatch()
+            metrics.samples(batch, self.timestamp(date))
+        finally:
+            # a day without a value must not carry the previous day's over
+            for source in self.sources:
+                metrics.forget(source, user)
+            metrics.updated.clear()
+            metrics.timestamps.clear()
+        return batch
+
+    def run(self):
+        done = self.load_checkpoint()
+        todo = [(connect, date) for connect in self.connects for date in self.dates()
+                if (connect.display_name, date) not in done]
+        self.logger.info('Backfilling {} account days, {} already done ...'.format(
+            len(todo), len(done)))
+
+        jobs = [((connect, date, source), getattr(connect, 'get_' + source), (date,))
+                for connect, date in todo for source in self.sources]
+        payloads = {}
+        for (connect, date, source), data in self.fetcher.run(jobs):
+            user = connect.display_name
+            payloads.setdefault((user, date), {})[source] = data
+            if len(payloads[(user, date)]) < len(self.sources):
+                continue
+            downloaded = payloads.pop((user, date))
+            failed = [name for name, data in downloaded.items() if data is None]
+            if failed:
+                # not checkpointed, the next run downloads the day again
+                self.logger.error('Could not download {} of {} for {}, leaving it for the next '
+                                  'run'.format(', '.join(sorted(failed)), date, user))
+                continue
+            batch = self.build(user, date, downloaded)
+            self.save_checkpoint(user, date, batch)
+            self.logger.info('Backfilled {} for {} ({} samples)'.format(date, user, len(batch)))
+
+        self.write_output()
+
+    def write_output(self):
+        batch = SampleBatch()
+        for samples in self.load_checkpoint().values():
+            for name, documentation, metric_type, labels, value, timestamp in samples:
+                batch.add(name, documentation, metric_type, labels, value, timestamp)
+        write_openmetrics(self.output, batch)
+        self.logger.info('Wrote {} samples to {}, load them with: '
+                         'promtool tsdb create-blocks-from openmetrics {} <prometheus data dir>'
+                         .format(len(batch), self.output, self.output))
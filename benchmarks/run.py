@@ -0,0 +1,257 @@
+'''
+Offline end-to-end benchmarks: runs collector.py against local stand-ins
+for garmin connect, the Pushgateway and grafana and prints one json
+result per scenario.
+
+    python benchmarks/run.py [--scenario NAME ...] [--output results.json]
+'''
+import argparse
+import datetime
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import stub_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLLECTOR = os.path.join(ROOT, 'collector.py')
+
+# name: (collector arguments, number of accounts, stub options, extra env, warm-up runs)
+SCENARIOS = {
+    'single': ([], 1, {}, {}, 0),
+    'single-cached': ([], 1, {}, {}, 1),
+    'single-cached-requests': ([], 1, {}, {'GARMIN_TRANSPORT': 'requests'}, 1),
+    'many-accounts': ([], 20, {}, {}, 0),
+    'intraday': ([], 5, {}, {'INTRADAY_SERIES': 'heart_rate,stress,steps',
+                             'INTRADAY_MAX_DAYS': '3'}, 0),
+    'activity-files': ([], 5, {}, {'ACTIVITY_FILES': 'true'}, 0),
+    'latency': ([], 1, {'latency': 0.2}, {}, 0),
+    'throttled': ([], 5, {'throttle_every': 4}, {'GARMIN_BACKOFF': '0.1'}, 0),
+    'remote-write': ([], 5, {}, {'METRICS_SINK': 'remote_write',
+                                 'INTRADAY_SERIES': 'heart_rate,stress,steps'}, 0),
+    'sinks': ([], 5, {}, {'METRICS_SINK': 'pushgateway,textfile,influxdb',
+                          'INTRADAY_SERIES': 'heart_rate,stress,steps'}, 0),
+    'backfill-365': (['backfill', '--from', '{year_ago}', '--to', '{yesterday}',
+                      '--workers', '8', '--rate', '0'], 1, {}, {}, 0),
+}
+
+STAGE = re.compile(r'^collector_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$', re.M)
+STAGE_LINE = re.compile(r'^collector_stage_duration_seconds_(sum|count),(?:\S*,)?stage=([^, ]+)\S* '
+                        r'value=(\S+)', re.M)
+
+
+def environment(base_url, state_dir, accounts):
+    accounts_file = os.path.join(state_dir, 'accounts.json')
+    with open(accounts_file, 'w') as f:
+        json.dump([{'username': 'user{}@example.com'.format(i), 'password': 'secret'}
+                   for i in range(accounts)], f)
+    env = dict(os.environ)
+    env.update({
+        'GARMIN_CONNECT_URL': base_url,
+        'GARMIN_SSO_URL': base_url,
+        'PUSHGATEWAY': base_url,
+        'REMOTE_WRITE_URL': base_url + '/api/v1/write',
+        'INFLUXDB_URL': base_url,
+        'GRAFANA_API': base_url + '/api',
+        'GRAFANA_API_KEY': 'stub',
+        'ACCOUNTS_FILE': accounts_file,
+        'STATE_DIR': state_dir,
+        'TIMEZONE': 'UTC',
+        # measure the collector, not the politeness towards garmin
+        'GARMIN_RATE': '0',
+        'FETCH_CONCURRENCY': '8',
+    })
+    return env
+
+
+def run_collector(arguments, env):
+    '''
+    Returns wall time in seconds, exit code and peak RSS in KB of one run
+    '''
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, COLLECTOR] + arguments, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    # os.waitstatus_to_exitcode is python 3.9+, the images run 3.7
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    wall_time = time.monotonic() - started
+    if process.returncode != 0:
+        sys.stderr.write(stderr.decode('utf-8', 'replace'))
+    # ru_maxrss is in KB on linux
+    return wall_time, process.returncode, usage.ru_maxrss
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def snappy_decompress(data):
+    length, position = read_varint(data, 0)
+    out = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[position:position + extra], 'little')
+                position += extra
+            size += 1
+            out += data[position:position + size]
+            position += size
+            continue
+        if kind == 1:
+            size = 4 + (tag >> 2 & 7)
+            offset = (tag >> 5) << 8 | data[position]
+            position += 1
+        else:
+            size = (tag >> 2) + 1
+            width = 2 if kind == 2 else 4
+            offset = int.from_bytes(data[position:position + width], 'little')
+            position += width
+        for _ in range(size):
+            out.append(out[-offset])
+    assert len(out) == length
+    return bytes(out)
+
+
+def protobuf_fields(data):
+    '''
+    Yield (field number, wire type, value) of one protobuf message, as
+    much of the wire format as a remote-write request uses
+    '''
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 2:
+            size, position = read_varint(data, position)
+            value = data[position:position + size]
+            position += size
+        else:
+            raise ValueError('unexpected wire type {}'.format(wire_type))
+        yield number, wire_type, value
+
+
+def remote_write_stages(body):
+    for number, _, series in protobuf_fields(snappy_decompress(body)):
+        labels = {}
+        value = None
+        for part, _, payload in protobuf_fields(series):
+            if part == 1:
+                pair = dict((key, text) for key, _, text in protobuf_fields(payload))
+                labels[pair[1].decode('utf-8')] = pair.get(2, b'').decode('utf-8')
+            elif part == 2:
+                for key, _, raw in protobuf_fields(payload):
+                    if key == 1:
+                        value = struct.unpack('<d', raw)[0]
+        kind = labels.get('__name__', '').rsplit('_', 1)[-1]
+        if labels.get('__name__') == 'collector_stage_duration_seconds_' + kind and \
+                kind in ('sum', 'count') and 'stage' in labels:
+            yield kind, labels['stage'], value
+
+
+def stages(state):
+    '''
+    {stage: {'sum': seconds, 'count': n}} from the collector's own metrics,
+    in whichever sink the run wrote them to. None when the run wrote none,
+    like a backfill.
+    '''
+    found = []
+    if state.pushes:
+        found = STAGE.findall(state.pushes[-1])
+    elif state.influx_writes:
+        found = STAGE_LINE.findall('\n'.join(state.influx_writes))
+    else:
+        for body in state.remote_writes:
+            found.extend(remote_write_stages(body))
+    if not found:
+        return None
+    result = {}
+    for kind, stage, value in found:
+        result.setdefault(stage, {})[kind] = float(value)
+    return result
+
+
+def run_scenario(name):
+    arguments, accounts, stub_options, extra_env, warm_up = SCENARIOS[name]
+    today = datetime.date.today()
+    arguments = [argument.format(
+        year_ago=(today - datetime.timedelta(days=365)).isoformat(),
+        yesterday=(today - datetime.timedelta(days=1)).isoformat(),
+    ) for argument in arguments]
+
+    state = stub_server.StubState(**stub_options)
+    server = stub_server.start(state)
+    state_dir = tempfile.mkdtemp(prefix='healthstats-bench-')
+    try:
+        env = environment('http://127.0.0.1:{}'.format(server.server_port), state_dir, accounts)
+        env.update(extra_env)
+        for _ in range(warm_up):
+            run_collector(arguments, env)
+        state.requests.clear()
+        del state.pushes[:]
+
+        wall_time, exit_code, peak_rss = run_collector(arguments, env)
+        result = {
+            'scenario': name,
+            'accounts': accounts,
+            'exit_code': exit_code,
+            'wall_time_seconds': round(wall_time, 3),
+            'peak_rss_kb': peak_rss,
+            'request_count': sum(count for endpoint, count in state.requests.items()
+                                 if endpoint != 'throttled'),
+            'requests': dict(state.requests),
+        }
+        found = stages(state)
+        if found is not None:
+            result['stages'] = found
+        return result
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run offline collector benchmarks')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, can be repeated, defaults to all of them')
+    parser.add_argument('--output', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(name)
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+import collections
+import datetime
+import io
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+SSO_PAGE = '''<html><body><form method="post">
+<input type="hidden" name="_csrf" value="{csrf}" />
+</form></body></html>'''
+
+TICKET_PAGE = '''<html><script>
+var response_url = "https://connect.garmin.com/modern?ticket=ST-{index}-stub-cas";
+</script></html>'''
+
+MODERN_PAGE = '''<html><script>
+VIEWER_USERPREFERENCES = {prefs};
+VIEWER_SOCIAL_PROFILE = {profile};
+</script></html>'''
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name + '.json')) as f:
+        return json.load(f)
+
+
+def day_start(date):
+    day = datetime.datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+    return int(day.timestamp() * 1000)
+
+
+def intraday(path, query):
+    '''
+    Synthetic intraday payloads for a date, a full day at garmin's sample
+    rates: heart rate every 2, stress and body battery every 3 and steps
+    every 15 minutes
+    '''
+    if '/dailyStress/' in path:
+        start = day_start(path.rsplit('/', 1)[1])
+        rows = range(start, start + 86400000, 180000)
+        return 'stress', {
+            'stressValueDescriptorsDTOList': [{'key': 'timestamp', 'index': 0},
+                                              {'key': 'stressLevel', 'index': 1}],
+            'stressValuesArray': [[ts, (ts // 180000) % 100 - 2] for ts in rows],
+            'bodyBatteryValueDescriptorsDTOList': [
+                {'bodyBatteryValueDescriptorIndex': index, 'bodyBatteryValueDescriptorKey': key}
+                for index, key in enumerate(('timestamp', 'bodyBatteryStatus',
+                                             'bodyBatteryLevel', 'bodyBatteryVersion'))],
+            'bodyBatteryValuesArray': [[ts, 'MEASURED', 5 + (ts // 180000) % 95, 2.0]
+                                       for ts in rows],
+        }
+    start = day_start(query.get('date'))
+    if '/dailyHeartRate/' in path:
+        return 'heart_rate', {
+            'heartRateValueDescriptors': [{'key': 'timestamp', 'index': 0},
+                                          {'key': 'heartrate', 'index': 1}],
+            'heartRateValues': [[ts, 50 + (ts // 120000) % 60]
+                                for ts in range(start, start + 86400000, 120000)],
+        }
+    fmt = '%Y-%m-%dT%H:%M:%S.0'
+    return 'steps', [{
+        'startGMT': datetime.datetime.utcfromtimestamp(ts / 1000).strftime(fmt),
+        'endGMT': datetime.datetime.utcfromtimestamp(ts / 1000 + 900).strftime(fmt),
+        'steps': (ts // 900000) % 400,
+        'primaryActivityLevel': 'active',
+    } for ts in range(start, start + 86400000, 900000)]
+
+
+def activity_file(activity):
+    '''
+    A zipped FIT file with one record a second for the whole activity:
+    timestamp, altitude, heart rate, cadence, speed and power
+    '''
+    start = activity['beginTimestamp'] // 1000 - 631065600
+    seconds = int(activity['duration'])
+    # local message 0 is a record: (field number, size, base type)
+    fields = ((253, 4, 0x86), (2, 2, 0x84), (3, 1, 0x02), (4, 1, 0x02), (6, 2, 0x84),
+              (7, 2, 0x84))
+    records = [struct.pack('<BBHB', 0, 0, 20, len(fields))]
+    records += [struct.pack('<BBB', *field) for field in fields]
+    definition = b'\x40' + b''.join(records)
+    record = struct.Struct('<BIHBBHH')
+    data = definition + b''.join(record.pack(
+        0, start + t, int((100 + 20 * ((t // 60) % 5) + 500) * 5),
+        120 + (t // 30) % 60, 80 + t % 10, 2500 + (t % 120) * 10, 150 + (t * 7) % 200)
+        for t in range(seconds))
+    header = struct.pack('<BBHI4s', 12, 0x20, 2132, len(data), b'.FIT')
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('{}_ACTIVITY.fit'.format(activity['activityId']),
+                         header + data + b'\x00\x00')
+    return out.getvalue()
+
+
+class StubState():
+    '''
+    Recorded garmin connect responses plus the pushgateway and grafana
+    write endpoints, with knobs for injected latency and throttling
+    '''
+    def __init__(self, latency=0.0, throttle_every=0):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.data_requests = 0
+        self.users = {}
+        self.pushes = []
+        self.remote_writes = []
+        self.influx_writes = []
+        self.annotations = {}
+        self.fixtures = {name: load_fixture(name)
+                         for name in ('summary', 'weight', 'sleep', 'activities')}
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def throttled(self):
+        if not self.throttle_every:
+            return False
+        with self.lock:
+            self.data_requests += 1
+            return self.data_requests % self.throttle_every == 0
+
+    def user_index(self, username):
+        with self.lock:
+            return self.users.setdefault(username, len(self.users))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def reply(self, code=200, body=b'', content_type='application/json', headers={}):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, data, code=200):
+        self.reply(code, json.dumps(data))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+        if path == '/sso/signin':
+            self.state.count('sso')
+            return self.reply(body=SSO_PAGE.format(csrf='stubcsrf'), content_type='text/html')
+        if path == '/modern':
+            self.state.count('modern')
+            index = re.search(r'ST-(\d+)-', query.get('ticket', 'ST-0-')).group(1)
+            prefs = {'displayName': 'user-{}'.format(index), 'measurementSystem': 'metric'}
+            profile = {'fullName': 'Stub User {}'.format(index)}
+            return self.reply(body=MODERN_PAGE.format(prefs=json.dumps(prefs),
+                                                      profile=json.dumps(profile)),
+                              content_type='text/html')
+        if path.startswith('/modern/proxy/'):
+            return self.garmin(path, query)
+        if path == '/api/annotations':
+            self.state.count('grafana')
+            tags = parse_qs(url.query).get('tags', [])
+            found = [dict(annotation, id=annotation_id)
+                     for annotation_id, annotation in self.state.annotations.items()
+                     if all(tag in annotation['tags'] for tag in tags)]
+            return self.reply_json(found)
+        self.reply(404)
+
+    def garmin(self, path, query):
+        fixtures = self.state.fixtures
+        if '/usersummary-service/' in path:
+            endpoint, data = 'summary', dict(fixtures['summary'],
+                                             calendarDate=query.get('calendarDate'))
+        elif '/weight-service/' in path:
+            endpoint, data = 'weight', fixtures['weight']
+        elif '/dailySleepData/' in path:
+            sleep = fixtures['sleep']
+            endpoint, data = 'sleep', dict(sleep, dailySleepDTO=dict(
+                sleep['dailySleepDTO'], calendarDate=query.get('date')))
+        elif '/activitylist-service/' in path:
+            start = int(query.get('start', 0))
+            limit = int(query.get('limit', 20))
+            endpoint, data = 'activities', fixtures['activities'][start:start + limit]
+        elif re.search(r'/daily(HeartRate|Stress|SummaryChart)/', path):
+            endpoint, data = intraday(path, query)
+        elif '/download-service/files/activity/' in path:
+            activity_id = int(path.rsplit('/', 1)[1])
+            found = [activity for activity in fixtures['activities']
+                     if activity['activityId'] == activity_id]
+            if not found:
+                return self.reply(404)
+            self.state.count('activity_files')
+            return self.reply(body=activity_file(found[0]), content_type='application/zip')
+        else:
+            return self.reply(404)
+
+        self.state.count(endpoint)
+        if self.state.throttled():
+            self.state.count('throttled')
+            return self.reply(429, b'{}', headers={'Retry-After': '0.1'})
+        self.reply_json(data)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.body()
+        if path == '/sso/signin':
+            self.state.count('sso')
+            username = parse_qs(body.decode('utf-8')).get('username', [''])[0]
+            index = self.state.user_index(username)
+            return self.reply(body=TICKET_PAGE.format(index=index), content_type='text/html')
+        if path.startswith('/metrics/'):
+            self.state.count('pushgateway')
+            with self.state.lock:
+                self.state.pushes.append(body.decode('utf-8'))
+            return self.reply(200)
+        if path == '/api/v1/write':
+            self.state.count('remote_write')
+            with self.state.lock:
+                self.state.remote_writes.append(body)
+            return self.reply(204)
+        if path in ('/write', '/api/v2/write'):
+            self.state.count('influxdb')
+            with self.state.lock:
+                self.state.influx_writes.append(body.decode('utf-8'))
+            return self.reply(204)
+        if path == '/api/annotations':
+            self.state.count('grafana')
+            with self.state.lock:
+                annotation_id = len(self.state.annotations) + 1
+                self.state.annotations[annotation_id] = json.loads(body)
+            return self.reply_json({'id': annotation_id, 'message': 'Annotation added'})
+        self.reply(404)
+
+    def do_PUT(self):
+        path = urlparse(self.path).path
+        body = self.body()
+        if path.startswith('/metrics/'):
+            self.state.count('pushgateway')
+            with self.state.lock:
+                self.state.pushes.append(body.decode('utf-8'))
+            return self.reply(200)
+        if path.startswith('/api/annotations/'):
+            self.state.count('grafana')
+            annotation_id = int(path.rsplit('/', 1)[1])
+            with self.state.lock:
+                self.state.annotations[annotation_id] = json.loads(body)
+            return self.reply_json({'message': 'Annotation updated'})
+        self.reply(404)
+
+
+def start(state, port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
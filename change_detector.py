@@ -0,0 +1,58 @@
+import hashlib
+import json
+
+
+class ChangeDetector():
+    # upstream fields that change whenever the payload does
+    version_keys = {
+        'summary': 'lastSyncTimestampGMT',
+        'weight': 'version',
+    }
+    # number of dates to remember per data source
+    keep_dates = 7
+
+    def __init__(self, logger, store):
+        self.logger = logger
+        self.store = store
+        self.pending = {}
+
+    def fingerprint(self, source, data):
+        version = None
+        if isinstance(data, dict):
+            version = data.get(self.version_keys.get(source))
+        if version is not None:
+            return str(version)
+        text = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def changed(self, source, user, date, data):
+        '''
+        Returns True when data differs from what was last committed for
+        this source, user and date. Empty payloads (failed downloads) never count
+        as a change.
+        '''
+        if not data:
+            return False
+        key = 'changes:{}:{}:{}'.format(source, user, date)
+        fingerprint = self.fingerprint(source, data)
+        if self.store.get(key) == fingerprint:
+            self.logger.info('{} data of {} for {} is unchanged'.format(source, user, date))
+            return False
+        self.pending[key] = (source, user, fingerprint)
+        return True
+
+    def commit(self, delivered):
+        '''
+        Remember the fingerprints of the delivered (source, user) pairs,
+        so the next run can skip them.
+        '''
+        for key in list(self.pending):
+            source, user, fingerprint = self.pending[key]
+            if (source, user) not in delivered:
+                continue
+            del self.pending[key]
+            self.store.set(key, fingerprint)
+            dates = sorted(self.store.keys('changes:{}:{}:'.format(source, user)))
+            for old in dates[:-self.keep_dates]:
+                self.store.delete(old)
+        self.store.save()
@@ -1,60 +1,471 @@
+# first, so the startup report counts from the start of the imports
+import startup
+
+import argparse
+import contextlib
+import cProfile
+import io
 import json
 import logging
 import os
+import pstats
 import sys
 import tempfile
 import time
+import traceback
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from garmin_connect import GarminConnect
-from grafana_api import GrafanaAPI
-from prometheus_metrics import PrometheusMetrics
+from accounts import load_accounts
+from fetcher import Fetcher
+from metric_specs import SPECS
+from startup import lazy_import
+
+# every mode imports the modules only it needs itself, so a run pays for
+# neither the other modes nor, through them, for requests, pytz and
+# prometheus_client before it needs them
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Collect health stats from garmin connect')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='run under cProfile and dump the stats to PATH')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='log how long startup, lazy imports and the first garmin '
+                             'connect request took')
+    commands = parser.add_subparsers(dest='command')
+
+    backfill = commands.add_parser('backfill', help='collect daily metrics for past dates')
+    backfill.add_argument('--from', dest='start', required=True, help='first date, YYYY-MM-DD')
+    backfill.add_argument('--to', dest='end', required=True, help='last date, YYYY-MM-DD')
+    backfill.add_argument('--workers', type=int, default=4,
+                          help='maximum number of requests in flight')
+    backfill.add_argument('--rate', type=float,
+                          help='maximum number of requests per second, retries included, '
+                               'instead of GARMIN_RATE, 0 for no limit')
+    backfill.add_argument('--output', help='OpenMetrics file to write the samples to')
+
+    serve = commands.add_parser('serve', help='stay resident, collect on a schedule and '
+                                              'expose the metrics on /metrics')
+    serve.add_argument('--port', type=int, default=int(os.environ.get('METRICS_PORT', '8000')),
+                       help='port for the /metrics endpoint')
+    serve.add_argument('--interval', type=int,
+                       default=int(os.environ.get('COLLECT_INTERVAL', '3600')),
+                       help='seconds between collections')
+
+    query = commands.add_parser('query', help='read daily, weekly or monthly rollups from '
+                                              'the local archive')
+    query.add_argument('metric', nargs='?', help='metric name, lists the archived metrics '
+                                                'when left out')
+    query.add_argument('--user', help='only this garmin connect display name')
+    query.add_argument('--period', choices=('day', 'week', 'month'), default='day')
+    query.add_argument('--from', dest='start', help='first date, YYYY-MM-DD')
+    query.add_argument('--to', dest='end', help='last date, YYYY-MM-DD')
+    query.add_argument('--format', choices=('table', 'json'), default='table')
 
+    grafana = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grafana')
+    provision = commands.add_parser('provision', help='upload the grafana datasources and '
+                                                      'dashboards that changed')
+    provision.add_argument('--datasources', default=os.path.join(grafana, 'datasources'),
+                           help='directory with datasource json files')
+    provision.add_argument('--dashboards', default=os.path.join(grafana, 'dashboards'),
+                           help='directory with dashboard json files')
+    provision.add_argument('--wait', type=int, default=120,
+                           help='seconds to wait for grafana to come up')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
 
-def main():
     logging.basicConfig(stream=sys.stdout,
                         level=logging.DEBUG,
                         format='%(asctime)s [%(name)s:%(levelname)s] %(message)s')
     logger = logging.getLogger()
 
-    connect = GarminConnect(logger)
-    metrics = PrometheusMetrics(logger)
-    grafana = GrafanaAPI(logger)
+    startup.mark('main')
+    try:
+        if args.profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(dispatch, logger, args)
+            finally:
+                profiler.dump_stats(args.profile)
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(25)
+                logger.info('Profile written to {}\n{}'.format(args.profile, report.getvalue()))
+        else:
+            dispatch(logger, args)
+    finally:
+        # also on sys.exit, a run that fails to log in is still worth timing
+        if args.startup_report:
+            logger.info(startup.report())
+
 
-    logger.info('Logging in to garmin connect ...')
-    if connect.login() == False:
-        logger.error('Failed to log into garmin connect')
+def dispatch(logger, args):
+    if args.command == 'backfill':
+        backfill(logger, args)
+    elif args.command == 'serve':
+        serve(logger, args)
+    elif args.command == 'query':
+        query(logger, args)
+    elif args.command == 'provision':
+        provision(logger, args)
+    else:
+        collect(logger)
+
+
+def accounts(logger, instrumentation=None):
+    from garmin_connect import GarminConnect
+    from request_scheduler import RequestScheduler
+
+    # every account gets its own GarminConnect, so sessions stay isolated,
+    # but they all share one request scheduler and with it one rate budget
+    scheduler = RequestScheduler(logger)
+    return [GarminConnect(logger, account['username'], account['password'], instrumentation,
+                          scheduler)
+            for account in load_accounts()]
+
+
+def login(logger, connects):
+    '''
+    Log into all accounts that are not logged in yet, concurrently,
+    and return the ones that are logged in.
+    '''
+    jobs = [(connect, login_once, (logger, connect))
+            for connect in connects if connect.login_time is None]
+    for _ in Fetcher(logger).run(jobs):
+        pass
+    return [connect for connect in connects if connect.login_time is not None]
+
+
+def login_once(logger, connect):
+    instrumentation = connect.instrumentation
+    logger.info('Logging in to garmin connect as {} ...'.format(connect.username))
+    with instrumentation.stage('login') if instrumentation else contextlib.nullcontext():
+        try:
+            if connect.login() == False:
+                logger.error('Failed to log into garmin connect as {}'.format(connect.username))
+                if instrumentation:
+                    instrumentation.auth_failure()
+                return False
+        except Exception:
+            logger.error(traceback.format_exc())
+            return False
+    return True
+
+
+def login_or_exit(logger, instrumentation=None, leases=None):
+    connects = accounts(logger, instrumentation)
+    if leases is not None:
+        connects = leases.claim(connects)
+        if not connects:
+            # the other replicas have them all
+            sys.exit(0)
+    connects = login(logger, connects)
+    if not connects:
         sys.exit(1)
+    return connects
+
+
+def backfill(logger, args):
+    from archive import Archive
+    from backfill import Backfill
+
+    connects = login_or_exit(logger)
+    Backfill(logger, connects, args.start, args.end,
+             workers=args.workers, rate=args.rate, output=args.output,
+             archive=Archive(logger)).run()
+
+
+def query(logger, args):
+    from archive import Archive
+
+    archive = Archive(logger)
+    if not args.metric:
+        for metric in archive.metrics():
+            print(metric)
+        return
+    rows = archive.query(args.metric, user=args.user, period=args.period,
+                         start=args.start, end=args.end)
+    if args.format == 'json':
+        print(json.dumps(rows, indent=2))
+        return
+    print('{:<10}  {:<20}  {:<20}  {:>5}  {:>12}  {:>12}  {:>12}'.format(
+        'start', 'user', 'labels', 'count', 'avg', 'min', 'max'))
+    for row in rows:
+        labels = ','.join('{}={}'.format(k, v) for k, v in sorted(row['labels'].items()))
+        print('{:<10}  {:<20}  {:<20}  {:>5}  {:>12.2f}  {:>12.2f}  {:>12.2f}'.format(
+            row['start'], row['user'], labels or '-', row['count'], row['avg'], row['min'],
+            row['max']))
+
+
+def provision(logger, args):
+    from grafana_api import GrafanaAPI
+
+    grafana = GrafanaAPI(logger)
+    if not grafana.api:
+        logger.error('GRAFANA_API is not set')
+        sys.exit(1)
+    if not grafana.wait_until_ready(args.wait):
+        sys.exit(1)
+    if grafana.provision(args.datasources, args.dashboards):
+        sys.exit(1)
+
+
+def collect(logger):
+    from archive import Archive
+    from change_detector import ChangeDetector
+    from grafana_api import GrafanaAPI
+    from outbox import Outbox
+    from prometheus_metrics import PrometheusMetrics
+    from state_store import StateStore
+
+    outbox = Outbox(logger)
+    metrics = PrometheusMetrics(logger, outbox)
+    grafana = GrafanaAPI(logger, outbox)
+    # whatever an earlier run could not deliver goes out first, so the
+    # fresh data of this run replaces it and not the other way round
+    outbox.replay({'metrics': metrics.replay, 'annotation': grafana.replay})
+    # with LEASES_PATH set, replicas split the accounts among themselves
+    leases = None
+    if os.environ.get('LEASES_PATH'):
+        from leases import Leases
+        leases = Leases(logger)
+    connects = login_or_exit(logger, metrics.instrumentation, leases)
+    changes = ChangeDetector(logger, StateStore())
+    run_cycle(logger, connects, metrics, grafana, changes, Archive(logger), publish=True)
+
+
+def serve(logger, args):
+    from archive import Archive
+    from change_detector import ChangeDetector
+    from grafana_api import GrafanaAPI
+    from outbox import Outbox
+    from prometheus_metrics import PrometheusMetrics
+    from state_store import StateStore
+
+    outbox = Outbox(logger)
+    metrics = PrometheusMetrics(logger)
+    connects = accounts(logger, metrics.instrumentation)
+    grafana = GrafanaAPI(logger, outbox)
+    changes = ChangeDetector(logger, StateStore())
+    archive = Archive(logger)
+    leases = None
+    if os.environ.get('LEASES_PATH'):
+        from leases import Leases
+        leases = Leases(logger)
+    flush_interval = int(os.environ.get('OUTBOX_FLUSH_INTERVAL', '60'))
+
+    logger.info('Serving metrics on :{}/metrics ...'.format(args.port))
+    lazy_import('prometheus_client').start_http_server(args.port, registry=metrics.registry)
+
+    while True:
+        try:
+            assigned = connects
+            if leases is not None:
+                assigned = leases.claim(connects)
+                for connect in connects:
+                    # another replica collects it now, stop exposing it here
+                    if connect.username in leases.released and connect.login_time:
+                        for group in SPECS:
+                            metrics.forget(group, connect.display_name)
+            active = login(logger, assigned)
+            if active:
+                run_cycle(logger, active, metrics, grafana, changes, archive, publish=False)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+        # line up with the interval boundaries, like the hourly crontab did
+        now = time.time()
+        next_run = (now // args.interval + 1) * args.interval
+        logger.info('Next collection in {} seconds'.format(int(next_run - now)))
+        # metrics are scraped in this mode, only annotations can be pending.
+        # they are retried while waiting, never at the same time as a run
+        while time.time() < next_run:
+            time.sleep(max(0, min(next_run - time.time(), flush_interval)))
+            if time.time() >= next_run:
+                break
+            if len(outbox):
+                outbox.replay({'annotation': grafana.replay})
+            if leases is not None:
+                try:
+                    leases.renew()
+                except Exception:
+                    logger.error(traceback.format_exc())
+
+
+def run_cycle(logger, connects, metrics, grafana, changes, archive, publish):
+    from activity_cursor import ActivityCursor
+    from activity_files import ActivityFiles
+    from intraday import Intraday
+    from sleep_timeline import SleepTimelines
+    from sync_policy import SyncPlanner
+    from trends import Trends
+
+    # all accounts share one bounded pool. every account's summary, weight
+    # and sleep is published on its own, as soon as it has been consumed and
+    # only if it changed since the last delivery, on a second small pool.
+    # activities go straight to grafana whenever they arrive, their FIT
+    # files are downloaded on the side. payloads and metrics are written
+    # through to the local archive as well
+    messages = {
+        'summary': 'Generating resting heart rate, steps, floor and calorie metrics for {} ...',
+        'weight': 'Generating weight metrics for {} ...',
+        'sleep': 'Generating sleep metrics for {} ...',
+        'activities': 'Creating grafana annotations for {} ...',
+    }
+    consumers = {
+        'summary': metrics.summary,
+        'weight': metrics.weight,
+        'sleep': metrics.sleep,
+        'activities': grafana.activities_as_annotations,
+    }
+    instrumentation = metrics.instrumentation
+    started = time.monotonic()
+    jobs = []
+    cursors = {}
+    intraday = Intraday(logger, changes.store, archive, metrics.sinks)
+    files = ActivityFiles(logger, archive)
+    trends = Trends(logger, changes.store)
+    timelines = SleepTimelines(logger, archive, metrics.sinks)
+    # sources that cannot have anything new are not downloaded at all. the
+    # pushgateway, grafana or (when serving) the registry still hold their
+    # values; a server that has not built a group since it started needs it
+    planner = SyncPlanner(logger, changes.store, changes.fingerprint)
+    for connect in connects:
+        user = connect.display_name
+        for name in ('summary', 'weight', 'sleep'):
+            if not planner.due(name, user, publish or (name, user) in metrics.timestamps):
+                continue
+            fetch, args = getattr(connect, 'get_' + name), ()
+            if name == 'sleep' and timelines.enabled:
+                # the same request, keeping the timeline of the night
+                fetch, args = timelines.fetch, (connect,)
+            fetch = instrumentation.timed('fetch_' + name, fetch)
+            jobs.append(((connect, name), fetch, args))
+        cursors[connect] = ActivityCursor(changes.store, user)
+        if planner.due('activities', user):
+            fetch = instrumentation.timed('fetch_activities', connect.get_activities)
+            jobs.append(((connect, 'activities'), fetch, (cursors[connect].since,)))
+        for kind in intraday.kinds:
+            fetch = instrumentation.timed('fetch_intraday_' + kind, intraday.fetch)
+            jobs.append(((connect, 'intraday_' + kind), fetch, (connect, kind)))
+    publisher = ThreadPoolExecutor(max_workers=int(os.environ.get('PUSH_CONCURRENCY', '4')))
+    pushes = {}
+
+    logger.info('Downloading summary, weight, sleep and activities data of {} accounts, '
+                '{} downloads skipped ...'.format(len(connects), len(planner.skipped)))
+    fetcher = Fetcher(logger)
+    for (connect, name), data in fetcher.run(jobs):
+        user = connect.display_name
+        date = data.get('calendarDate') if isinstance(data, dict) else None
+        date = date or connect.today()
 
-    logger.info('Downloading summary data ...')
-    data = connect.get_summary()
-    logger.info('Generating resting heart rate, steps, floor and calorie metrics ...')
-    metrics.summary(data)
+        if name == 'activities':
+            # activities are a stream, later pages are only downloaded as
+            # grafana consumes them. grafana keeps its own index of synced
+            # activities, the cursor only limits how far back to page
+            logger.info(messages[name].format(user))
+            with instrumentation.stage('annotations'):
+                activities = archive.activities(user, cursors[connect].track(data))
+                consumers[name](files.track(connect, activities), user)
+            cursors[connect].commit()
+            newest = cursors[connect].newest
+            planner.record(name, user, newest['activityId'] if newest else cursors[connect].since)
+            instrumentation.success(name, user)
+            continue
 
-    time.sleep(1)
+        if name.startswith('intraday_'):
+            # written out together at the end of the run, see below
+            intraday.add(user, data)
+            if any(data.values()):
+                instrumentation.success(name, user)
+            continue
 
-    logger.info('Downloading weight data ...')
-    data = connect.get_weight()
-    logger.info('Generating weight metrics ...')
-    metrics.weight(data)
+        # a failed download (None) builds nothing, like an empty one
+        data = data or {}
+        logger.info(messages[name].format(user))
+        metrics.updated.discard((name, user))
+        with instrumentation.stage('build_' + name):
+            consumers[name](data, user)
+        if data:
+            instrumentation.success(name, user)
+        planner.record(name, user, data)
+        with instrumentation.stage('archive'):
+            archive.payload(user, name, date, data)
+            if (name, user) in metrics.updated:
+                archive.daily(user, date, metrics.values(name, user))
+        if (name, user) in metrics.updated:
+            trends.update(name, user, date, data)
+        if publish and (name, user) in metrics.updated and \
+                changes.changed(name, user, date, data):
+            logger.info('Publishing {} metrics of {} ...'.format(name, user))
+            push = instrumentation.timed('push', metrics.publish)
+            pushes[publisher.submit(push, name, user)] = (name, user)
 
-    time.sleep(1)
+    if files.enabled:
+        with instrumentation.stage('activity_files'):
+            exported = files.finish(connects)
+        for user, activities in exported.items():
+            metrics.activities(user, activities)
+            # one set per user, not per date: it is pushed whenever it changes
+            if publish and activities and \
+                    changes.changed('activity', user, 'latest', activities):
+                logger.info('Publishing activity metrics of {} ...'.format(user))
+                push = instrumentation.timed('push', metrics.publish)
+                pushes[publisher.submit(push, 'activity', user)] = ('activity', user)
 
-    logger.info('Downloading sleep data ...')
-    data = connect.get_sleep()
-    logger.info('Generating sleep metrics ...')
-    metrics.sleep(data)
+    # trends follow from all of a user's daily values, so they are
+    # published once everything is in
+    for connect in connects:
+        user = connect.display_name
+        values = trends.values(user)
+        metrics.apply('trends', values, user)
+        if publish and user in trends.updated and \
+                changes.changed('trends', user, 'latest', values):
+            logger.info('Publishing trend metrics of {} ...'.format(user))
+            push = instrumentation.timed('push', metrics.publish)
+            pushes[publisher.submit(push, 'trends', user)] = ('trends', user)
+    if trends.updated or planner.recorded:
+        changes.store.save()
 
-    logger.info('Publishing metrics to Pushgateway ...')
-    metrics.publish()
+    # a failed push only holds back its own source, it is sent again next run
+    delivered = []
+    for future, (name, user) in pushes.items():
+        try:
+            future.result()
+            delivered.append((name, user))
+        except Exception:
+            logger.error(traceback.format_exc())
+    publisher.shutdown()
+    if publish:
+        logger.info('Published {} of {} changed metric groups'.format(len(delivered), len(pushes)))
+        changes.commit(delivered)
 
-    time.sleep(1)
+    if intraday.kinds:
+        with instrumentation.stage('intraday'):
+            try:
+                intraday.flush()
+            except Exception:
+                # the high-water marks stay put, the samples are sent next run
+                logger.error(traceback.format_exc())
+    if timelines.enabled:
+        with instrumentation.stage('sleep_timeline'):
+            try:
+                timelines.flush()
+            except Exception:
+                # the nights stay in the archive, they are written next run
+                logger.error(traceback.format_exc())
 
-    logger.info('Downloading activities data ...')
-    data = connect.get_activities()
-    logger.info('Creating grafana annotations ...')
-    grafana.activities_as_annotations(data)
+    instrumentation.run_duration.set(time.monotonic() - started)
+    if publish:
+        try:
+            metrics.publish('collector')
+        except Exception:
+            logger.error(traceback.format_exc())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,47 @@
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class Fetcher():
+    def __init__(self, logger, concurrency=None, spacing=None):
+        self.logger = logger
+        if concurrency is None:
+            concurrency = int(os.environ.get('FETCH_CONCURRENCY', '4'))
+        if spacing is None:
+            spacing = float(os.environ.get('FETCH_SPACING', '0'))
+        self.concurrency = max(1, concurrency)
+        self.spacing = max(0.0, spacing)
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def wait_turn(self):
+        # spread request start times at least `spacing` seconds apart,
+        # no matter how many workers are waiting to go
+        if self.spacing == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.spacing
+        if start > now:
+            time.sleep(start - now)
+
+    def call(self, fn, args):
+        self.wait_turn()
+        return fn(*args)
+
+    def run(self, jobs):
+        '''
+        Run (key, fn, args) jobs on a bounded thread pool and yield
+        (key, result) pairs in the order they complete, so callers can
+        consume each payload as soon as it arrives.
+        '''
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {}
+            for key, fn, args in jobs:
+                futures[pool.submit(self.call, fn, args)] = key
+            for future in as_completed(futures):
+                yield futures[future], future.result()
@@ -0,0 +1,168 @@
+import struct
+import zipfile
+
+from array import array
+
+# seconds between the unix epoch and the FIT epoch, 1989-12-31T00:00:00Z
+FIT_EPOCH = 631065600
+
+# base type: (struct code, invalid value). strings, byte arrays and the
+# like are skipped as raw bytes
+BASE_TYPES = {
+    0x00: ('B', 0xff),
+    0x01: ('b', 0x7f),
+    0x02: ('B', 0xff),
+    0x83: ('h', 0x7fff),
+    0x84: ('H', 0xffff),
+    0x85: ('i', 0x7fffffff),
+    0x86: ('I', 0xffffffff),
+    0x88: ('f', None),
+    0x89: ('d', None),
+    0x0a: ('B', 0x00),
+    0x8b: ('H', 0x0000),
+    0x8c: ('I', 0x00000000),
+    0x8e: ('q', 0x7fffffffffffffff),
+    0x8f: ('Q', 0xffffffffffffffff),
+    0x90: ('Q', 0x0000000000000000),
+}
+
+RECORD = 20
+TIMESTAMP = 253
+
+# record field number: (column, scale, offset). the enhanced fields come
+# later in a message and win over the 16 bit ones they extend
+RECORD_FIELDS = {
+    2: ('altitude', 5, 500),
+    3: ('heart_rate', 1, 0),
+    4: ('cadence', 1, 0),
+    5: ('distance', 100, 0),
+    6: ('speed', 1000, 0),
+    7: ('power', 1, 0),
+    73: ('speed', 1000, 0),
+    78: ('altitude', 5, 500),
+}
+
+COLUMNS = ('timestamp', 'heart_rate', 'speed', 'cadence', 'power', 'altitude', 'distance')
+
+
+class FitError(Exception):
+    pass
+
+
+def read_file(path):
+    '''
+    Bytes of a FIT file, or of the first FIT file in a zip, the way garmin
+    connect hands out original activity files
+    '''
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist() if name.lower().endswith('.fit')]
+            if not names:
+                raise FitError('no FIT file in {}'.format(path))
+            return archive.read(names[0])
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Definition():
+    '''
+    A definition message compiled once into a struct for the whole data
+    message and the positions of the fields that are kept
+    '''
+    __slots__ = ('message', 'struct', 'fields', 'timestamp')
+
+    def __init__(self, message, endian, fields, developer_size):
+        codes = []
+        self.message = message
+        self.fields = []
+        self.timestamp = None
+        for number, size, base_type in fields:
+            code, invalid = BASE_TYPES.get(base_type, (None, None))
+            if code is None or struct.calcsize('<' + code) != size:
+                # strings and arrays
+                codes.append('{}s'.format(size))
+                continue
+            if number == TIMESTAMP:
+                self.timestamp = len(codes)
+            if message == RECORD and number in RECORD_FIELDS:
+                self.fields.append((len(codes), invalid) + RECORD_FIELDS[number])
+            codes.append(code)
+        if developer_size:
+            codes.append('{}s'.format(developer_size))
+        self.struct = struct.Struct(endian + ''.join(codes))
+
+
+def parse_records(data):
+    '''
+    Parse the record messages of a FIT file into parallel array('d')
+    columns, see COLUMNS, with NaN for a field a record does not have.
+    Timestamps are unix seconds.
+    '''
+    if len(data) < 12 or data[8:12] != b'.FIT':
+        raise FitError('not a FIT file')
+    header_size = data[0]
+    end = min(len(data), header_size + struct.unpack_from('<I', data, 4)[0])
+    columns = {name: array('d') for name in COLUMNS}
+    nan = float('nan')
+    definitions = {}
+    last_timestamp = 0
+    position = header_size
+    while position < end:
+        header = data[position]
+        position += 1
+        if header & 0x80:
+            # compressed timestamp header: 5 bits of offset to the last timestamp
+            local = (header >> 5) & 0x03
+            offset = header & 0x1f
+            timestamp = (last_timestamp & ~0x1f) + offset
+            if offset < last_timestamp & 0x1f:
+                timestamp += 0x20
+            last_timestamp = timestamp
+        elif header & 0x40:
+            local = header & 0x0f
+            if position + 5 > end:
+                break
+            endian = '>' if data[position + 1] else '<'
+            message, count = struct.unpack_from(endian + 'HB', data, position + 2)
+            position += 5
+            fields = [tuple(data[position + 3 * i:position + 3 * i + 3]) for i in range(count)]
+            position += 3 * count
+            developer_size = 0
+            if header & 0x20:
+                developer_count = data[position]
+                position += 1
+                developer_size = sum(data[position + 3 * i + 1] for i in range(developer_count))
+                position += 3 * developer_count
+            definitions[local] = Definition(message, endian, fields, developer_size)
+            continue
+        else:
+            local = header & 0x0f
+            timestamp = None
+
+        definition = definitions.get(local)
+        if definition is None:
+            raise FitError('data message without a definition at {}'.format(position))
+        if position + definition.struct.size > end:
+            break
+        values = definition.struct.unpack_from(data, position)
+        position += definition.struct.size
+        if definition.timestamp is not None:
+            last_timestamp = values[definition.timestamp]
+            timestamp = last_timestamp
+        if definition.message != RECORD:
+            continue
+
+        record = dict.fromkeys(COLUMNS, nan)
+        if timestamp is not None:
+            record['timestamp'] = timestamp + FIT_EPOCH
+        for index, invalid, column, scale, offset in definition.fields:
+            value = values[index]
+            if value != invalid:
+                record[column] = value / scale - offset
+        for name in COLUMNS:
+            columns[name].append(record[name])
+    return columns
+
+
+def read_records(path):
+    return parse_records(read_file(path))
@@ -1,17 +1,22 @@
-import cloudscraper
 import datetime
 import json
 import os
-import pytz
 import re
+import tempfile
+import threading
 import time
 import traceback
 
+from request_scheduler import RequestScheduler
+from session_cache import SessionCache
+from startup import lazy_import, mark
+
 
 class GarminConnect():
-    base_url = "https://connect.garmin.com"
+    # overridable for local stand-ins, like the benchmark stub server
+    base_url = os.environ.get('GARMIN_CONNECT_URL', "https://connect.garmin.com")
 
-    sso_url = 'https://sso.garmin.com/sso'
+    sso_url = os.environ.get('GARMIN_SSO_URL', 'https://sso.garmin.com') + '/sso'
     sso_login_url = sso_url + '/signin'
     login_url = base_url + '/signin'
 
@@ -22,38 +27,158 @@ class GarminConnect():
     personal_info_url = user_profile_url + '/personal-information'
     wellness_url = modern_proxy_url + '/wellness-service/wellness'
     sleep_daily_url = wellness_url + '/dailySleepData'
+    heart_rate_daily_url = wellness_url + '/dailyHeartRate'
+    stress_daily_url = wellness_url + '/dailyStress'
+    summary_chart_url = wellness_url + '/dailySummaryChart'
     summary_url = modern_proxy_url + '/usersummary-service/usersummary/daily'
     weight_url = modern_proxy_url + '/weight-service/weight/latest'
     activities_url = modern_proxy_url + '/activitylist-service/activities/search/activities'
+    activity_download_url = modern_proxy_url + '/download-service/files/activity'
+
+    # sent by the plain requests transport, which has no browser emulation
+    user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:91.0) Gecko/20100101 Firefox/91.0'
 
-    def __init__(self, logger):
+    def __init__(self, logger, username=None, password=None, instrumentation=None,
+                 scheduler=None):
         self.logger = logger
-        self.session = cloudscraper.create_scraper(
-            browser={
-                'browser': 'firefox',
-                'platform': 'windows',
-                'mobile': False
-            }
-        )
-        self.username = os.environ.get('GARMIN_USERNAME')
-        self.password = os.environ.get('GARMIN_PASSWORD')
+        self.instrumentation = instrumentation
+        self.scheduler = scheduler or RequestScheduler(logger)
+        # cloudscraper: every request goes through cloudscraper, like it always did
+        # requests: a plain pooled session for the json endpoints, cloudscraper
+        # is only imported and set up when the SSO handshake needs it
+        self.transport = os.environ.get('GARMIN_TRANSPORT', 'cloudscraper')
+        self.scraper = None
+        if self.transport == 'requests':
+            requests = lazy_import('requests')
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=int(os.environ.get('FETCH_CONCURRENCY', '4')))
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.session.headers['User-Agent'] = self.user_agent
+        else:
+            self.session = self.sso_session()
+        self.username = username or os.environ.get('GARMIN_USERNAME')
+        self.password = password or os.environ.get('GARMIN_PASSWORD')
         self.timezone = os.environ.get('TIMEZONE', 'UTC')
-        self.localtime = self.to_localtime(datetime.datetime.now())
-        self.formatted_date = self.localtime.strftime("%Y-%m-%d")
+        self.activities_page_size = int(os.environ.get('ACTIVITIES_PAGE_SIZE', '10'))
+        self.session_cache = SessionCache(logger, self.username)
+        self.from_cache = False
+        self.auth_lock = threading.Lock()
+        self.auth_generation = 0
+        self.login_time = None
+        if instrumentation is not None:
+            self.session.hooks['response'].append(self.on_response)
+
+    def sso_session(self):
+        '''
+        The cloudflare-aware session, created on first use: it is the slow
+        part of starting up and can launch nodejs.
+        '''
+        if self.scraper is None:
+            cloudscraper = lazy_import('cloudscraper')
+            self.scraper = cloudscraper.create_scraper(
+                browser={
+                    'browser': 'firefox',
+                    'platform': 'windows',
+                    'mobile': False
+                }
+            )
+            if self.instrumentation is not None and self.transport == 'requests':
+                self.scraper.hooks['response'].append(self.on_response)
+        return self.scraper
+
+    def endpoint(self, url):
+        # most specific urls first, display names and ids are left out
+        for name, prefix in (('summary', self.summary_url),
+                             ('weight', self.weight_url),
+                             ('sleep', self.sleep_daily_url),
+                             ('heart_rate', self.heart_rate_daily_url),
+                             ('stress', self.stress_daily_url),
+                             ('steps', self.summary_chart_url),
+                             ('activities', self.activities_url),
+                             ('activity_files', self.activity_download_url),
+                             ('modern', self.modern_url),
+                             ('sso', self.sso_url)):
+            if url.startswith(prefix):
+                return name
+        return 'other'
+
+    def on_response(self, response, *args, **kwargs):
+        self.instrumentation.response(self.endpoint(response.request.url), response)
+        if response.status_code in (401, 403):
+            self.instrumentation.auth_failure()
 
     def to_localtime(self, datetime_in_utc):
-        return pytz.timezone(self.timezone).fromutc(datetime_in_utc)
+        return lazy_import('pytz').timezone(self.timezone).fromutc(datetime_in_utc)
 
-    def get(self, url, params={}, headers={}):
-        response = self.session.get(url, params=params, headers=headers)
-        response.raise_for_status()
-        return response
+    def today(self):
+        return self.to_localtime(datetime.datetime.utcnow()).strftime("%Y-%m-%d")
+
+    def get(self, url, params={}, headers={}, session=None, reauth=True):
+        session = session or self.session
+        return self.request(url, lambda: session.get(url, params=params, headers=headers),
+                            reauth)
 
-    def post(self, url, params, data, headers={}):
-        response = self.session.post(url, params=params, data=data, headers=headers)
+    def post(self, url, params, data, headers={}, session=None, reauth=True):
+        session = session or self.session
+        return self.request(url, lambda: session.post(url, params=params, data=data,
+                                                      headers=headers), reauth)
+
+    def request(self, url, send, reauth=True, stream=False):
+        # throttling, retries and backoff are left to the shared scheduler.
+        # the login requests themselves never log in again: they run under
+        # auth_lock when a rejected session is replaced
+        mark('first_request')
+        endpoint = self.endpoint(url)
+        generation = self.auth_generation
+        response = self.scheduler.execute(endpoint, send, self.retried)
+        if reauth and self.reauthenticate(response, generation):
+            self.retried(endpoint)
+            response = self.scheduler.execute(endpoint, send, self.retried)
+        if not stream and self.instrumentation is not None and \
+                'Content-Length' not in response.headers:
+            # already read, unlike a streamed body
+            self.instrumentation.received(endpoint, len(response.content))
         response.raise_for_status()
         return response
 
+    def retried(self, endpoint):
+        if self.instrumentation is not None:
+            self.instrumentation.retry(endpoint)
+
+    def reauthenticate(self, response, generation):
+        '''
+        When a session restored from the cache, or one that has been alive for
+        a while (long-running mode), gets rejected, throw it away and do a full
+        SSO login. Returns True if the request should be retried, either because
+        this call logged in again or a concurrent one already did.
+        '''
+        if response.status_code not in (401, 403):
+            return False
+        with self.auth_lock:
+            if generation != self.auth_generation:
+                return True
+            if self.login_time is None:
+                return False
+            if not self.from_cache and time.time() - self.login_time < 300:
+                return False
+            self.logger.info('Garmin connect session was rejected, logging in again ...')
+            self.from_cache = False
+            self.login_time = None
+            self.session_cache.clear()
+            self.session.cookies.clear()
+            if self.scraper is not None:
+                self.scraper.cookies.clear()
+            try:
+                if not self.sso_login():
+                    return False
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                return False
+            self.auth_generation += 1
+            return True
+
     def get_json(self, page_html, key):
         found = re.search(key + r" = (\{.*\});", page_html, re.M)
         if found:
@@ -61,6 +186,27 @@ class GarminConnect():
             return json.loads(json_text)
 
     def login(self):
+        return self.restore_session() or self.sso_login()
+
+    def restore_session(self):
+        cache = self.session_cache.load()
+        if cache is None:
+            return False
+        for cookie in cache['cookies']:
+            self.session.cookies.set(cookie['name'], cookie['value'],
+                                     domain=cookie['domain'],
+                                     path=cookie['path'],
+                                     secure=cookie['secure'],
+                                     expires=cookie['expires'])
+        self.display_name = cache['profile']['display_name']
+        self.english_units = cache['profile']['english_units']
+        self.full_name = cache['profile']['full_name']
+        self.from_cache = True
+        self.login_time = time.time()
+        self.logger.info('Restored garmin connect session from cache')
+        return True
+
+    def sso_login(self):
         params = {
             'service': self.modern_url,
             'webhost': self.modern_url,
@@ -100,9 +246,10 @@ class GarminConnect():
             'rememberMyBrowserShown': 'true',
             'rememberMyBrowserChecked': 'false',
         }
+        session = self.sso_session()
         response = self.get(self.sso_login_url, params, headers={
             'Referer': self.login_url,
-        })
+        }, session=session, reauth=False)
         found = re.search(r'<input.+name="_csrf".+value="(\w*)".+/>', response.text, re.M)
         if not found:
             return False
@@ -115,20 +262,32 @@ class GarminConnect():
         response = self.post(self.sso_login_url, params, data, headers={
             'Referer': response.url,
             'Content-Type': 'application/x-www-form-urlencoded'
-        })
+        }, session=session, reauth=False)
         found = re.search(r"\?ticket=([\w-]*)", response.text, re.M)
         if not found:
             return False
         params = {'ticket' : found.group(1)}
-        response = self.get(self.modern_url, params)
+        response = self.get(self.modern_url, params, session=session, reauth=False)
+        if session is not self.session:
+            # hand the authenticated cookies over to the json session
+            self.session.cookies.update(session.cookies)
         self.user_prefs = self.get_json(response.text, 'VIEWER_USERPREFERENCES')
         self.display_name = self.user_prefs['displayName']
         self.english_units = (self.user_prefs['measurementSystem'] == 'statute_us')
         self.social_profile = self.get_json(response.text, 'VIEWER_SOCIAL_PROFILE')
         self.full_name = self.social_profile['fullName']
+        self.login_time = time.time()
+        self.session_cache.save(self.session.cookies, {
+            'display_name': self.display_name,
+            'english_units': self.english_units,
+            'full_name': self.full_name,
+        })
         return True
 
-    def get_summary(self):
+    # get_summary, get_weight, get_sleep and get_sleep_data return None when
+    # the download failed, and an empty payload when there is no data
+
+    def get_summary(self, date=None):
         '''
         {
         	"userProfileId": 48251499,
@@ -208,16 +367,16 @@ class GarminConnect():
         '''
         try:
             response = self.get(self.summary_url + '/' + self.display_name, {
-                'calendarDate': self.formatted_date,
+                'calendarDate': date or self.today(),
             }, headers={
                 'NK': 'NT'
             })
             return response.json()
         except Exception:
             self.logger.error(traceback.format_exc())
-        return {}
+        return None
 
-    def get_weight(self):
+    def get_weight(self, date=None):
         '''
         {
         	"date": 1548666397000,
@@ -237,16 +396,16 @@ class GarminConnect():
         '''
         try:
             response = self.get(self.weight_url, {
-                'date': self.formatted_date,
+                'date': date or self.today(),
             }, headers={
                 'NK': 'NT'
             })
             return response.json()
         except Exception:
             self.logger.error(traceback.format_exc())
-        return {}
+        return None
 
-    def get_sleep(self):
+    def get_sleep(self, date=None):
         '''
         {'dailySleepDTO': {
 	    	'sleepQualityTypePK': None,
@@ -272,25 +431,65 @@ class GarminConnect():
 	    	'sleepWindowConfirmed': True
 	    }}
         '''
+        data = self.get_sleep_data(date)
+        if data is None:
+            return None
+        if 'dailySleepDTO' in data:
+            return data['dailySleepDTO']
+        if data:
+            self.logger.info('no daily sleep data from garmin connect')
+        return {}
+
+    def get_sleep_data(self, date=None):
+        '''
+        The whole daily sleep response: dailySleepDTO (see get_sleep) and
+        the per-epoch arrays of the night
+
+        {'dailySleepDTO': {...},
+         'sleepLevels': [{'startGMT': '2018-10-18T02:05:00.0', 'endGMT': '2018-10-18T02:25:00.0', 'activityLevel': 1.0}, ...],
+         'sleepHeartRate': [{'value': 50, 'startGMT': 1539828300000}, ...],
+         'wellnessEpochSpO2DataDTOList': [{'epochTimestamp': '2018-10-18T02:05:00.0', 'spo2Reading': 92, ...}, ...],
+         'wellnessEpochRespirationDataDTOList': [{'startTimeGMT': 1539828300000, 'respirationValue': 12.0}, ...]}
+        '''
         try:
             response = self.get(self.sleep_daily_url + '/' + self.display_name, {
-                'date': self.formatted_date
+                'date': date or self.today()
             }, headers={
                 'NK': 'NT'
             })
-            data = response.json()
-            if 'dailySleepDTO' in data:
-                return data['dailySleepDTO']
-            self.logger.info('no daily sleep data from garmin connect')
+            return response.json() or {}
         except Exception:
             self.logger.error(traceback.format_exc())
-        return {}
+        return None
+
+    def get_activities(self, since=None):
+        '''
+        Returns a generator over activities, newest first. The first page is
+        downloaded right away, later pages only as the caller consumes them,
+        and paging stops at the page holding the activity with id `since`
+        (the high-water mark of the last run). Without a mark only the first
+        page is returned.
+        '''
+        page = self.get_activities_page(0)
+        return self.iter_activities(page, since)
+
+    def iter_activities(self, page, since):
+        start = 0
+        while True:
+            for activity in page:
+                yield activity
+            if since is None or len(page) < self.activities_page_size:
+                return
+            if any(activity['activityId'] <= since for activity in page):
+                return
+            start += len(page)
+            page = self.get_activities_page(start)
 
-    def get_activities(self):
+    def get_activities_page(self, start):
         try:
             response = self.get(self.activities_url, {
-                'start': 0,
-                'limit': 10
+                'start': start,
+                'limit': self.activities_page_size
             }, headers={
                 'NK': 'NT'
             })
@@ -298,3 +497,92 @@ class GarminConnect():
         except Exception:
             self.logger.error(traceback.format_exc())
         return []
+
+    def download_activity(self, activity_id, path):
+        '''
+        Stream the original file of an activity, a zip holding the FIT
+        file, to path. Raises on errors, a 404 means there is no file, like
+        for manually entered activities.
+        '''
+        url = '{}/{}'.format(self.activity_download_url, activity_id)
+        response = self.request(url, lambda: self.session.get(url, stream=True), stream=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        size = 0
+        try:
+            with response, os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp, path)
+            if self.instrumentation is not None and 'Content-Length' not in response.headers:
+                self.instrumentation.received(self.endpoint(url), size)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def get_heart_rate_intraday(self, date=None):
+        '''
+        {
+            "calendarDate": "2019-01-28",
+            "restingHeartRate": 71,
+            "heartRateValueDescriptors": [
+                {"key": "timestamp", "index": 0},
+                {"key": "heartrate", "index": 1}
+            ],
+            "heartRateValues": [[1548662400000, 68], [1548662520000, 67], ...]
+        }
+        '''
+        return self.get_intraday(self.heart_rate_daily_url + '/' + self.display_name, {
+            'date': date or self.today(),
+        })
+
+    def get_stress_intraday(self, date=None):
+        '''
+        Stress and body battery share one payload
+        {
+            "calendarDate": "2019-01-28",
+            "stressValueDescriptorsDTOList": [
+                {"key": "timestamp", "index": 0},
+                {"key": "stressLevel", "index": 1}
+            ],
+            "stressValuesArray": [[1548662400000, 23], [1548662580000, -1], ...],
+            "bodyBatteryValueDescriptorsDTOList": [
+                {"bodyBatteryValueDescriptorIndex": 0, "bodyBatteryValueDescriptorKey": "timestamp"},
+                {"bodyBatteryValueDescriptorIndex": 1, "bodyBatteryValueDescriptorKey": "bodyBatteryStatus"},
+                {"bodyBatteryValueDescriptorIndex": 2, "bodyBatteryValueDescriptorKey": "bodyBatteryLevel"},
+                {"bodyBatteryValueDescriptorIndex": 3, "bodyBatteryValueDescriptorKey": "bodyBatteryVersion"}
+            ],
+            "bodyBatteryValuesArray": [[1548662400000, "MEASURED", 42, 2.0], ...]
+        }
+        '''
+        return self.get_intraday(self.stress_daily_url + '/' + (date or self.today()), {})
+
+    def get_steps_intraday(self, date=None):
+        '''
+        [
+            {
+                "startGMT": "2019-01-28T08:00:00.0",
+                "endGMT": "2019-01-28T08:15:00.0",
+                "steps": 0,
+                "primaryActivityLevel": "sleeping",
+                "activityLevelConstant": true
+            },
+            ...
+        ]
+        '''
+        return self.get_intraday(self.summary_chart_url + '/' + self.display_name, {
+            'date': date or self.today(),
+        })
+
+    def get_intraday(self, url, params):
+        # None rather than an empty payload on errors, so the caller does
+        # not move its high-water mark past a day it could not download
+        try:
+            response = self.get(url, params, headers={
+                'NK': 'NT'
+            })
+            return response.json()
+        except Exception:
+            self.logger.error(traceback.format_exc())
+        return None
@@ -1,55 +1,155 @@
 import datetime
+import glob
+import hashlib
+import json
 import math
 import os
-import pytz
-import requests
+import time
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor
+
+from startup import lazy_import
+from state_store import StateStore
+
 
 class GrafanaAPI():
-    def __init__(self, logger):
+    def __init__(self, logger, outbox=None):
         self.logger = logger
+        self.outbox = outbox
         self.timezone = os.environ.get('TIMEZONE', 'UTC')
         self.api = os.environ.get('GRAFANA_API')
         self.api_key = os.environ.get('GRAFANA_API_KEY')
+        self.concurrency = int(os.environ.get('GRAFANA_CONCURRENCY', '4'))
+        self.index = StateStore('annotations.json')
+
+        # one keep-alive session for every grafana request
+        requests = lazy_import('requests')
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        if self.api_key:
+            self.session.headers['Authorization'] = 'Bearer {}'.format(self.api_key)
+        elif os.environ.get('GRAFANA_USER'):
+            # provisioning runs before anyone could create an API key
+            self.session.auth = (os.environ['GRAFANA_USER'],
+                                 os.environ.get('GRAFANA_PASSWORD', ''))
 
-    def activities_as_annotations(self, activities):
-        tz = pytz.timezone(self.timezone)
-        utc = datetime.datetime.now()
-        now = tz.fromutc(utc)
-        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        seconds_from_midnight = (now - midnight).seconds
-
-        # start from 1 hour ago and end at the current time
-        from_time = now - datetime.timedelta(hours=1)
-        to_time = now
-
-        # when it's the first hour of the day, start from 2 hours ago
-        # so we can also grab the activities from the last hour of yesterday
-        if seconds_from_midnight <= 3600:
-            from_time = now - datetime.timedelta(hours=2)
-
-        for activity in activities:
-            ts = math.floor(activity['beginTimestamp'] / 1000)
-            utc = datetime.datetime.utcfromtimestamp(ts)
-            duration = math.ceil(activity['duration'])
-            delta = datetime.timedelta(seconds=duration)
-            time = tz.fromutc(utc)
-            time_end = time + delta
-            if from_time < time <= to_time \
-                or from_time < time_end <= to_time:
-                self.annotation({
+    def activities_as_annotations(self, activities, user):
+        '''
+        Sync activities to grafana annotations keyed on activityId: new
+        activities are added, edited ones updated and the rest left alone,
+        so late syncs and re-runs neither lose nor duplicate annotations.
+        '''
+        tz = lazy_import('pytz').timezone(self.timezone)
+        # annotations are sent while later activities are still streaming in
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = []
+            for activity in activities:
+                ts = math.floor(activity['beginTimestamp'] / 1000)
+                utc = datetime.datetime.utcfromtimestamp(ts)
+                duration = math.ceil(activity['duration'])
+                delta = datetime.timedelta(seconds=duration)
+                time = tz.fromutc(utc)
+                time_end = time + delta
+                futures.append(pool.submit(self.sync, activity['activityId'], user, {
                     'time': int(time.timestamp() * 1000),
                     'timeEnd': int(time_end.timestamp() * 1000),
                     'isRegion': True,
-                    'tags': ['healthstats'],
+                    'tags': ['healthstats', user, 'activity:{}'.format(activity['activityId'])],
                     'text': '{} with time {}, average HR {}, and calories {}'.format(
                         activity['activityName'],
                         str(delta),
                         activity['averageHR'],
                         activity['calories']
                     )
-                })
+                }))
+            for future in futures:
+                future.result()
+        self.index.save()
+
+    def sync(self, activity_id, user, data):
+        key = '{}:{}'.format(user, activity_id)
+        known = self.index.get(key)
+        if known is not None and known['hash'] == self.digest(data):
+            return
+
+        # recorded before it is sent, so it survives grafana being down
+        entry = None
+        if self.outbox is not None:
+            entry = self.outbox.add('annotation', key, {
+                'activity_id': activity_id,
+                'user': user,
+                'data': data,
+            })
+        if self.send(activity_id, user, data) and entry is not None:
+            self.outbox.ack(entry)
+
+    def digest(self, data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def send(self, activity_id, user, data):
+        '''
+        Add or update the annotation of one activity, returns True once
+        grafana has it
+        '''
+        key = '{}:{}'.format(user, activity_id)
+        known = self.index.get(key)
+
+        # not in the local index (first run, lost state): ask grafana
+        # before adding, so the annotation is never created twice
+        annotation_id = known['id'] if known else self.find(data['tags'][-1])
+        if annotation_id is None:
+            annotation_id = self.annotation(data)
+        else:
+            self.logger.info('Updating annotation {} for activity {}'.format(
+                annotation_id, activity_id))
+            if not self.update(annotation_id, data):
+                annotation_id = None
+        if annotation_id is None:
+            return False
+        self.index.set(key, {'id': annotation_id, 'hash': self.digest(data)})
+        return True
+
+    def replay(self, entries):
+        '''
+        Outbox handler: send pending annotations, returns the ids that
+        went through
+        '''
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = pool.map(lambda entry: self.send(entry['payload']['activity_id'],
+                                                       entry['payload']['user'],
+                                                       entry['payload']['data']), entries)
+            delivered = [entry['id'] for entry, sent in zip(entries, results) if sent]
+        self.index.save()
+        return delivered
+
+    def find(self, tag):
+        try:
+            response = self.session.get(self.api + '/annotations', params={
+                'tags': tag,
+                'type': 'annotation',
+                'limit': 1,
+            })
+            response.raise_for_status()
+            found = response.json()
+            if found:
+                return found[0]['id']
+        except Exception:
+            self.logger.error(traceback.format_exc())
+        return None
+
+    def update(self, annotation_id, data):
+        try:
+            response = self.session.put(
+                self.api + '/annotations/{}'.format(annotation_id), json=data)
+            response.raise_for_status()
+            return True
+        except Exception:
+            self.logger.error(traceback.format_exc())
+        return False
 
     def annotation(self, data):
         '''
@@ -64,10 +164,100 @@ class GrafanaAPI():
         }
         '''
         try:
-            response = requests.post(self.api + '/annotations', json=data, headers={
-                'Authorization': 'Bearer {}'.format(self.api_key),
-                'Context-Type': 'application/json'
-            })
+            response = self.session.post(self.api + '/annotations', json=data)
             self.logger.info(response.text)
-        except Exception as e:
+            response.raise_for_status()
+            return response.json().get('id')
+        except Exception:
             self.logger.error(traceback.format_exc())
+        return None
+
+    def wait_until_ready(self, timeout=120):
+        '''
+        Poll grafana's health endpoint, quickly at first and backing off to
+        every 2 seconds, until it answers or timeout seconds passed
+        '''
+        requests = lazy_import('requests')
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while True:
+            try:
+                if self.session.get(self.api + '/health', timeout=5).status_code == 200:
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            if time.monotonic() + delay > deadline:
+                self.logger.error('Grafana at {} is not ready after {} seconds'.format(
+                    self.api, timeout))
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+    def provision(self, datasources, dashboards):
+        '''
+        Make grafana's datasources and dashboards match the json files in
+        the given directories. Each object is compared with what grafana
+        already has by content hash, only changed ones are uploaded, all of
+        them in parallel. Returns the number of objects that failed.
+        '''
+        jobs = [(self.provision_datasource, path)
+                for path in sorted(glob.glob(os.path.join(datasources, '*.json')))]
+        jobs += [(self.provision_dashboard, path)
+                 for path in sorted(glob.glob(os.path.join(dashboards, '*.json')))]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = list(pool.map(lambda job: self.provision_one(*job), jobs))
+        self.logger.info('Provisioned {} objects: {} uploaded, {} unchanged, {} failed'.format(
+            len(results), results.count('uploaded'), results.count('unchanged'),
+            results.count('failed')))
+        return results.count('failed')
+
+    def provision_one(self, provision, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            uploaded = provision(data)
+            self.logger.info('{} {}'.format('Uploaded' if uploaded else 'Unchanged', path))
+            return 'uploaded' if uploaded else 'unchanged'
+        except Exception:
+            self.logger.error('Cannot provision {}: {}'.format(path, traceback.format_exc()))
+            return 'failed'
+
+    def provision_datasource(self, datasource):
+        response = self.session.get(self.api + '/datasources/name/' + datasource['name'])
+        if response.status_code == 404:
+            self.session.post(self.api + '/datasources', json=datasource).raise_for_status()
+            return True
+        response.raise_for_status()
+        existing = response.json()
+        # grafana fills in more fields than a file sets, only compare those
+        if self.digest({key: existing.get(key) for key in datasource}) == \
+                self.digest(datasource):
+            return False
+        self.session.put(self.api + '/datasources/{}'.format(existing['id']),
+                         json=dict(datasource, id=existing['id'])).raise_for_status()
+        return True
+
+    def provision_dashboard(self, data):
+        dashboard = data.get('dashboard', data)
+        # set by grafana on every save, not part of the content
+        managed = ('id', 'uid', 'version')
+        content = {key: value for key, value in dashboard.items() if key not in managed}
+        response = self.session.get(self.api + '/search', params={
+            'query': dashboard['title'],
+            'type': 'dash-db',
+        })
+        response.raise_for_status()
+        found = [item for item in response.json() if item.get('title') == dashboard['title']]
+        if found:
+            response = self.session.get(self.api + '/dashboards/uid/' + found[0]['uid'])
+            response.raise_for_status()
+            existing = response.json()['dashboard']
+            if self.digest({key: value for key, value in existing.items()
+                            if key not in managed}) == self.digest(content):
+                return False
+        self.session.post(self.api + '/dashboards/db', json={
+            'dashboard': dict(content, id=None),
+            'folderId': 0,
+            'overwrite': True,
+        }).raise_for_status()
+        return True
@@ -0,0 +1,93 @@
+import time
+
+from contextlib import contextmanager
+
+from startup import lazy_import
+
+
+class Instrumentation:
+    """
+    Metrics about the collector itself, registered next to the health
+    metrics so they are published and scraped the same way
+    """
+
+    def __init__(self, registry):
+        client = lazy_import("prometheus_client")
+        self.run_duration = client.Gauge(
+            "collector_run_duration_seconds",
+            "Wall time of the last collection run",
+            registry=registry,
+        )
+        self.stage_duration = client.Histogram(
+            "collector_stage_duration_seconds",
+            "Time spent per collection stage",
+            ["stage"],
+            registry=registry,
+        )
+        self.http_duration = client.Histogram(
+            "collector_http_request_duration_seconds",
+            "Garmin connect request latency",
+            ["endpoint", "status"],
+            registry=registry,
+        )
+        self.http_bytes = client.Counter(
+            "collector_http_response_bytes",
+            "Garmin connect response body bytes",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.http_retries = client.Counter(
+            "collector_http_retries",
+            "Garmin connect requests that were retried",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.auth_failures = client.Counter(
+            "collector_auth_failures",
+            "Rejected garmin connect sessions and failed logins",
+            registry=registry,
+        )
+        self.last_success = client.Gauge(
+            "collector_last_success_timestamp_seconds",
+            "Last time a data source was downloaded and processed successfully",
+            ["source", "user"],
+            registry=registry,
+        )
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stage_duration.labels(stage=name).observe(time.monotonic() - start)
+
+    def timed(self, name, fn):
+        def wrapper(*args):
+            with self.stage(name):
+                return fn(*args)
+
+        return wrapper
+
+    def response(self, endpoint, response):
+        self.http_duration.labels(
+            endpoint=endpoint, status=str(response.status_code)
+        ).observe(response.elapsed.total_seconds())
+        # a session hook runs before the body is read, reading it here would
+        # load streamed downloads into memory. bodies without a length are
+        # counted by whoever reads them, see received()
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit():
+            self.http_bytes.labels(endpoint=endpoint).inc(int(length))
+
+    def received(self, endpoint, size):
+        self.http_bytes.labels(endpoint=endpoint).inc(size)
+
+    def retry(self, endpoint):
+        self.http_retries.labels(endpoint=endpoint).inc()
+
+    def auth_failure(self):
+        self.auth_failures.inc()
+
+    def success(self, source, user):
+        self.last_success.labels(source=source, user=user).set_to_current_time()
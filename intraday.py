@@ -0,0 +1,284 @@
+import datetime
+import os
+import sys
+import traceback
+
+from array import array
+from collections import OrderedDict
+
+from samples import SampleBatch, write_openmetrics
+from startup import lazy_import
+
+# series name: (metric name, help text)
+SERIES = {
+    'heart_rate': ('heart_rate_intraday', 'Heart rate samples during the day'),
+    'stress': ('stress_level_intraday', 'Stress level samples during the day'),
+    'body_battery': ('body_battery_intraday', 'Body battery samples during the day'),
+    'steps': ('steps_intraday', 'Steps per interval, stamped at the end of the interval'),
+}
+
+# garmin connect request: series it returns
+KINDS = {
+    'heart_rate': ('heart_rate',),
+    'stress': ('stress', 'body_battery'),
+    'steps': ('steps',),
+}
+
+# little-endian on disk, whatever the host
+SWAP = sys.byteorder == 'big'
+
+
+class Series():
+    '''
+    One intraday series as two parallel arrays, timestamps in milliseconds
+    since epoch and values, about 16 bytes per sample instead of a list
+    and a float object each
+    '''
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.values = array('d')
+
+    def append(self, timestamp, value):
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def extend(self, other):
+        self.timestamps.extend(other.timestamps)
+        self.values.extend(other.values)
+
+    def last(self):
+        return self.timestamps[-1] if self.timestamps else None
+
+    def pack(self):
+        '''
+        The timestamps and the values as two blobs
+        '''
+        blobs = []
+        for column in (self.timestamps, self.values):
+            if SWAP:
+                column = array(column.typecode, column)
+                column.byteswap()
+            blobs.append(column.tobytes())
+        return blobs
+
+    @classmethod
+    def unpack(cls, timestamps, values):
+        series = cls()
+        series.timestamps.frombytes(timestamps)
+        series.values.frombytes(values)
+        if SWAP:
+            series.timestamps.byteswap()
+            series.values.byteswap()
+        return series
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+def column(descriptors, key, default, key_field='key', index_field='index'):
+    for descriptor in descriptors or ():
+        if descriptor.get(key_field) == key:
+            return descriptor.get(index_field, default)
+    return default
+
+
+def parse_rows(rows, ts_index, value_index, after, valid=lambda value: True):
+    '''
+    Copy [timestamp, value, ...] rows newer than `after` into a Series,
+    in timestamp order
+    '''
+    series = Series()
+    for row in sorted(rows or (), key=lambda row: row[ts_index]):
+        timestamp = row[ts_index]
+        value = row[value_index] if len(row) > value_index else None
+        if value is None or not valid(value):
+            continue
+        if after is not None and timestamp <= after:
+            continue
+        series.append(timestamp, value)
+    return series
+
+
+def parse_heart_rate(data, marks):
+    descriptors = data.get('heartRateValueDescriptors')
+    return {'heart_rate': parse_rows(data.get('heartRateValues'),
+                                     column(descriptors, 'timestamp', 0),
+                                     column(descriptors, 'heartrate', 1),
+                                     marks.get('heart_rate'))}
+
+
+def parse_stress(data, marks):
+    stress = data.get('stressValueDescriptorsDTOList')
+    battery = data.get('bodyBatteryValueDescriptorsDTOList')
+    battery_keys = ('bodyBatteryValueDescriptorKey', 'bodyBatteryValueDescriptorIndex')
+    return {
+        # negative stress levels mean not measured: activity, off wrist, too much motion
+        'stress': parse_rows(data.get('stressValuesArray'),
+                             column(stress, 'timestamp', 0),
+                             column(stress, 'stressLevel', 1),
+                             marks.get('stress'),
+                             valid=lambda value: value >= 0),
+        'body_battery': parse_rows(data.get('bodyBatteryValuesArray'),
+                                   column(battery, 'timestamp', 0, *battery_keys),
+                                   column(battery, 'bodyBatteryLevel', 2, *battery_keys),
+                                   marks.get('body_battery')),
+    }
+
+
+def parse_steps(data, marks):
+    rows = []
+    for interval in data or ():
+        end = interval.get('endGMT')
+        if not end:
+            continue
+        end = datetime.datetime.strptime(end[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+        rows.append((int(end.timestamp() * 1000), interval.get('steps')))
+    return {'steps': parse_rows(rows, 0, 1, marks.get('steps'))}
+
+
+PARSERS = {
+    'heart_rate': parse_heart_rate,
+    'stress': parse_stress,
+    'steps': parse_steps,
+}
+
+
+class Intraday():
+    '''
+    Incremental download of intraday series. A persisted high-water mark
+    per user and series (the timestamp of the last sample written) limits
+    each run to the days, and the samples, that are newer. Samples are
+    kept in array-backed Series, sent to the sinks that keep sample
+    timestamps, which the Pushgateway cannot, or written to an OpenMetrics
+    file per run in INTRADAY_OUTPUT, and folded into the archive's daily
+    rollups. With neither they are held in the archive until a run has
+    somewhere to write them.
+    '''
+    def __init__(self, logger, store, archive=None, sinks=()):
+        self.logger = logger
+        self.store = store
+        self.archive = archive
+        self.kinds = [kind.strip() for kind in os.environ.get('INTRADAY_SERIES', '').split(',')
+                      if kind.strip() in KINDS]
+        self.max_days = int(os.environ.get('INTRADAY_MAX_DAYS', '7'))
+        # no files unless asked for, one per run adds up
+        self.output_dir = os.environ.get('INTRADAY_OUTPUT')
+        # the sinks that keep sample timestamps
+        self.sinks = [sink for sink in sinks if sink.timestamps]
+        self.timezone = os.environ.get('TIMEZONE', 'UTC')
+        self.pending = {}
+        self.added = []
+
+    def marks(self, user):
+        return self.store.get('intraday:{}'.format(user)) or {}
+
+    def dates(self, user, kind):
+        '''
+        Local calendar dates from the one holding the oldest high-water mark
+        of this kind's series up to today, at most max_days of them
+        '''
+        tz = lazy_import('pytz').timezone(self.timezone)
+        today = tz.fromutc(datetime.datetime.utcnow()).date()
+        marks = self.marks(user)
+        oldest = min((marks[name] for name in KINDS[kind] if name in marks), default=None)
+        first = today
+        if oldest is not None:
+            first = datetime.datetime.fromtimestamp(oldest / 1000.0, tz).date()
+        first = max(first, today - datetime.timedelta(days=self.max_days - 1))
+        day = first
+        while day <= today:
+            yield day.strftime('%Y-%m-%d')
+            day += datetime.timedelta(days=1)
+
+    def fetch(self, connect, kind):
+        '''
+        Download and parse one kind of intraday data of one account, returns
+        {series name: Series} with only the samples past the high-water marks
+        '''
+        user = connect.display_name
+        marks = self.marks(user)
+        download = getattr(connect, 'get_{}_intraday'.format(kind))
+        result = {name: Series() for name in KINDS[kind]}
+        for date in self.dates(user, kind):
+            # each payload is dropped as soon as it is parsed, only the
+            # compact arrays are kept
+            data = download(date)
+            if data is None:
+                break
+            try:
+                for name, series in PARSERS[kind](data, marks).items():
+                    result[name].extend(series)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                break
+        return result
+
+    def add(self, user, result):
+        for name, series in result.items():
+            if not series:
+                continue
+            self.pending.setdefault(user, {})[name] = series.last()
+            self.added.append((user, name, series))
+
+    def flush(self):
+        '''
+        Write the samples gathered this run, after those held back by
+        earlier runs, to the sinks that keep timestamps, or to a new
+        OpenMetrics file in INTRADAY_OUTPUT without one. With neither they
+        are held in the archive instead. Then fold them into the archive's
+        rollups and move the high-water marks past them.
+        '''
+        added, self.added = self.added, []
+        pending, self.pending = self.pending, {}
+        writable = bool(self.sinks or self.output_dir)
+        held = self.archive.held_series() if writable and self.archive is not None else []
+        if not added and not held:
+            return None
+        if not writable and self.archive is None:
+            # the marks stay put, the samples are downloaded again
+            self.logger.warning('No sink keeps timestamps and INTRADAY_OUTPUT is not set, '
+                                'dropping {} intraday series'.format(len(added)))
+            return None
+
+        path = None
+        if writable:
+            merged = OrderedDict()
+            for user, name, start, timestamps, values in held:
+                merged.setdefault((user, name), Series()).extend(Series.unpack(timestamps, values))
+            for user, name, series in added:
+                merged.setdefault((user, name), Series()).extend(series)
+            batch = SampleBatch()
+            for (user, name), series in merged.items():
+                metric, documentation = SERIES[name]
+                batch.add_series(metric, documentation, 'gauge', {'user': user},
+                                 series.timestamps, series.values)
+            if self.sinks:
+                path = ', '.join(sink.url for sink in self.sinks)
+                for sink in self.sinks:
+                    sink.write({'source': 'intraday'}, batch)
+            else:
+                os.makedirs(self.output_dir, exist_ok=True)
+                path = os.path.join(self.output_dir, 'intraday-{}.om'.format(
+                    datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+                write_openmetrics(path, batch)
+                self.logger.info('Wrote {} intraday samples to {}'.format(len(batch), path))
+            if held:
+                self.archive.release_series([(user, name, start) for user, name, start, _, _ in held])
+        else:
+            for user, name, series in added:
+                self.archive.hold_series(user, name, series.timestamps[0], *series.pack())
+            self.logger.warning('No sink keeps timestamps and INTRADAY_OUTPUT is not set, '
+                                'holding {} intraday series in the archive'.format(len(added)))
+
+        if self.archive is not None:
+            for user, name, series in added:
+                self.archive.series(user, SERIES[name][0], series.timestamps, series.values)
+        for user, last in pending.items():
+            key = 'intraday:{}'.format(user)
+            marks = self.store.get(key) or {}
+            marks.update(last)
+            self.store.set(key, marks)
+        self.store.save()
+        return path
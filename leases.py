@@ -0,0 +1,139 @@
+import bisect
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS replicas (
+    instance TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    account TEXT PRIMARY KEY,
+    instance TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+'''
+
+# points per replica on the hash ring, enough to spread accounts evenly
+VIRTUAL_NODES = 64
+
+
+def instance_name():
+    '''
+    Name of this collector replica when accounts are sharded (LEASES_PATH
+    is set), INSTANCE_NAME or the host name, otherwise None
+    '''
+    if not os.environ.get('LEASES_PATH'):
+        return None
+    return os.environ.get('INSTANCE_NAME') or socket.gethostname()
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def build_ring(instances):
+    return sorted((ring_hash('{}#{}'.format(instance, node)), instance)
+                  for instance in instances for node in range(VIRTUAL_NODES))
+
+
+def owner(ring, account):
+    '''
+    The replica owning an account: the first point on the ring at or after
+    the account's hash. Adding or removing a replica only moves the
+    accounts next to its own points.
+    '''
+    index = bisect.bisect_left(ring, (ring_hash(account),))
+    return ring[index % len(ring)][1]
+
+
+class Leases():
+    '''
+    Splits the accounts among collector replicas sharing a SQLite file
+    (LEASES_PATH, on a volume every replica mounts). Every replica writes a
+    heartbeat, accounts are assigned to the live replicas by consistent
+    hashing, and a replica only collects the accounts it holds a lease on.
+    A lease is only taken over once its holder gave it up or it expired,
+    so an account is never collected by two replicas at once, and the
+    accounts of a replica that died move on after LEASE_TTL seconds.
+    '''
+    def __init__(self, logger, path=None):
+        self.logger = logger
+        self.path = path or os.environ.get('LEASES_PATH')
+        self.instance = instance_name() or socket.gethostname()
+        # long enough to span the time between two runs of a replica
+        interval = int(os.environ.get('COLLECT_INTERVAL', '3600'))
+        self.ttl = float(os.environ.get('LEASE_TTL', str(2 * interval)))
+        self.lock = threading.Lock()
+        # autocommit, transactions are started explicitly. no WAL, it does
+        # not work across hosts sharing a network file system
+        self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.released = set()
+
+    def claim(self, connects):
+        '''
+        Heartbeat, then take or renew the leases of the accounts this
+        replica owns and give up the ones it no longer owns. Returns the
+        connects of the accounts held, the released usernames are left in
+        self.released.
+        '''
+        now = time.time()
+        usernames = {connect.username for connect in connects}
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('INSERT OR REPLACE INTO replicas VALUES (?, ?)',
+                                (self.instance, now))
+                self.db.execute('DELETE FROM replicas WHERE heartbeat < ?', (now - 10 * self.ttl,))
+                live = [row[0] for row in self.db.execute(
+                    'SELECT instance FROM replicas WHERE heartbeat >= ?', (now - self.ttl,))]
+                ring = build_ring(live)
+                held = set()
+                for username in usernames:
+                    if owner(ring, username) != self.instance:
+                        continue
+                    # an expired lease or one of our own, nobody else's
+                    cursor = self.db.execute(
+                        'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (account) DO UPDATE '
+                        'SET instance = excluded.instance, expires = excluded.expires '
+                        'WHERE leases.instance = excluded.instance OR leases.expires < ?',
+                        (username, self.instance, now + self.ttl, now))
+                    if cursor.rowcount:
+                        held.add(username)
+                # also the ones held before a restart
+                released = {row[0] for row in self.db.execute(
+                    'SELECT account FROM leases WHERE instance = ?', (self.instance,))} - held
+                for username in released:
+                    self.db.execute('DELETE FROM leases WHERE account = ? AND instance = ?',
+                                    (username, self.instance))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.released = released
+        self.logger.info('{} holds {} of {} accounts, {} replicas are live'.format(
+            self.instance, len(held), len(usernames), len(live)))
+        return [connect for connect in connects if connect.username in held]
+
+    def renew(self):
+        '''
+        Heartbeat and extend the held leases, between runs
+        '''
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('INSERT OR REPLACE INTO replicas VALUES (?, ?)',
+                                (self.instance, now))
+                self.db.execute('UPDATE leases SET expires = ? WHERE instance = ?',
+                                (now + self.ttl, self.instance))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
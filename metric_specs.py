@@ -0,0 +1,351 @@
+from collections import namedtuple
+
+# key: field in the garmin connect payload
+# name, documentation: prometheus metric name and help text
+# scale: multiplier applied to the raw value, e.g. 1 / 1000.0 for grams to KG
+# labels: static labels, for fields that share one metric family
+# skip_zero: treat 0 as missing, for fields where garmin uses 0 for no data
+MetricSpec = namedtuple(
+    "MetricSpec",
+    ["key", "name", "documentation", "scale", "labels", "skip_zero"],
+    defaults=[1, {}, False],
+)
+
+GRAMS = 1 / 1000.0
+
+SUMMARY = (
+    # heart rate
+    MetricSpec("restingHeartRate", "resting_heart_rate", "Resting heart rate"),
+    MetricSpec("restingHeartRate", "heart_rate_resting", "Resting heart rate"),
+    MetricSpec("minHeartRate", "heart_rate_min", "Minimum heart rate"),
+    MetricSpec("maxHeartRate", "heart_rate_max", "Maximum heart rate"),
+    MetricSpec(
+        "lastSevenDaysAvgRestingHeartRate",
+        "heart_rate_resting_7d_avg",
+        "Average resting heart rate of the last seven days",
+    ),
+    MetricSpec(
+        "minAvgHeartRate", "heart_rate_min_avg", "Minimum of the average heart rate"
+    ),
+    MetricSpec(
+        "maxAvgHeartRate", "heart_rate_max_avg", "Maximum of the average heart rate"
+    ),
+    # intensity minutes
+    MetricSpec(
+        "moderateIntensityMinutes",
+        "intensity_minutes_moderate",
+        "Minutes in moderate intensity activities",
+    ),
+    MetricSpec(
+        "vigorousIntensityMinutes",
+        "intensity_minutes_vigorous",
+        "Minutes in vigorous intensity activities",
+    ),
+    MetricSpec(
+        "intensityMinutesGoal", "intensity_minutes_goal", "Intensity minutes goal"
+    ),
+    # steps
+    MetricSpec("totalSteps", "steps", "Total steps"),
+    MetricSpec("dailyStepGoal", "steps_daily_goal", "Daily step goal"),
+    MetricSpec("totalDistanceMeters", "distance_meters", "Total distance in meters"),
+    MetricSpec("activeSeconds", "active_seconds", "Seconds in movement"),
+    MetricSpec(
+        "highlyActiveSeconds",
+        "highly_active_seconds",
+        "Seconds in highly active movement",
+    ),
+    MetricSpec(
+        "sedentarySeconds", "sedentary_seconds", "Seconds in sedentary position"
+    ),
+    MetricSpec("sleepingSeconds", "sleeping_seconds", "Seconds sleeping"),
+    # floors
+    MetricSpec("floorsAscended", "floors_ascended", "Floors ascended"),
+    MetricSpec(
+        "floorsAscendedInMeters", "floors_ascended_meters", "Floors ascended in meters"
+    ),
+    MetricSpec("floorsDescended", "floors_descended", "Floors descended"),
+    MetricSpec(
+        "floorsDescendedInMeters",
+        "floors_descended_meters",
+        "Floors descended in meters",
+    ),
+    MetricSpec(
+        "userFloorsAscendedGoal", "floors_ascended_goal", "Floors ascended goal"
+    ),
+    # calories
+    MetricSpec("totalKilocalories", "calories", "Total calories"),
+    MetricSpec("activeKilocalories", "calories_active", "Active calories"),
+    MetricSpec("bmrKilocalories", "calories_resting", "Resting calories"),
+    MetricSpec("consumedKilocalories", "calories_consumed", "Consumed calories"),
+    # stress
+    MetricSpec("averageStressLevel", "stress_level_avg", "Average stress level"),
+    MetricSpec("maxStressLevel", "stress_level_max", "Maximum stress level"),
+    MetricSpec(
+        "totalStressDuration",
+        "stress_total_duration_seconds",
+        "Seconds with a measured stress level",
+    ),
+    MetricSpec(
+        "restStressDuration",
+        "stress_duration_seconds",
+        "Seconds per stress level",
+        labels={"level": "rest"},
+    ),
+    MetricSpec(
+        "lowStressDuration",
+        "stress_duration_seconds",
+        "Seconds per stress level",
+        labels={"level": "low"},
+    ),
+    MetricSpec(
+        "mediumStressDuration",
+        "stress_duration_seconds",
+        "Seconds per stress level",
+        labels={"level": "medium"},
+    ),
+    MetricSpec(
+        "highStressDuration",
+        "stress_duration_seconds",
+        "Seconds per stress level",
+        labels={"level": "high"},
+    ),
+    MetricSpec(
+        "activityStressDuration",
+        "stress_duration_seconds",
+        "Seconds per stress level",
+        labels={"level": "activity"},
+    ),
+    MetricSpec(
+        "uncategorizedStressDuration",
+        "stress_duration_seconds",
+        "Seconds per stress level",
+        labels={"level": "uncategorized"},
+    ),
+    MetricSpec(
+        "restStressPercentage",
+        "stress_percentage",
+        "Percentage of the day per stress level",
+        labels={"level": "rest"},
+    ),
+    MetricSpec(
+        "lowStressPercentage",
+        "stress_percentage",
+        "Percentage of the day per stress level",
+        labels={"level": "low"},
+    ),
+    MetricSpec(
+        "mediumStressPercentage",
+        "stress_percentage",
+        "Percentage of the day per stress level",
+        labels={"level": "medium"},
+    ),
+    MetricSpec(
+        "highStressPercentage",
+        "stress_percentage",
+        "Percentage of the day per stress level",
+        labels={"level": "high"},
+    ),
+    # body battery
+    MetricSpec(
+        "bodyBatteryChargedValue", "body_battery_charged", "Body battery charged"
+    ),
+    MetricSpec(
+        "bodyBatteryDrainedValue", "body_battery_drained", "Body battery drained"
+    ),
+    MetricSpec(
+        "bodyBatteryHighestValue", "body_battery_highest", "Highest body battery"
+    ),
+    MetricSpec("bodyBatteryLowestValue", "body_battery_lowest", "Lowest body battery"),
+    MetricSpec(
+        "bodyBatteryMostRecentValue",
+        "body_battery_most_recent",
+        "Most recent body battery",
+    ),
+    # pulse ox and respiration
+    MetricSpec("averageSpo2", "spo2_avg", "Average SpO2 in %"),
+    MetricSpec("lowestSpo2", "spo2_lowest", "Lowest SpO2 in %"),
+    MetricSpec("latestSpo2", "spo2_latest", "Latest SpO2 in %"),
+    MetricSpec(
+        "avgWakingRespirationValue",
+        "respiration_waking_avg",
+        "Average waking respiration in breaths per minute",
+    ),
+    MetricSpec(
+        "highestRespirationValue",
+        "respiration_highest",
+        "Highest respiration in breaths per minute",
+    ),
+    MetricSpec(
+        "lowestRespirationValue",
+        "respiration_lowest",
+        "Lowest respiration in breaths per minute",
+    ),
+)
+
+WEIGHT = (
+    MetricSpec("weight", "weight_total", "Body weight in KG", GRAMS, skip_zero=True),
+    MetricSpec("bodyFat", "weight_body_fat", "Body fat in %"),
+    MetricSpec("boneMass", "weight_bone_mass", "Bone mass in KG", GRAMS),
+    MetricSpec("bmi", "weight_bmi", "BMI"),
+    MetricSpec("bodyWater", "weight_body_water", "Body water in %"),
+    MetricSpec("muscleMass", "weight_muscle_mass", "Muscle mass in KG", GRAMS),
+    MetricSpec("visceralFat", "weight_visceral_fat", "Visceral fat rating"),
+    MetricSpec("metabolicAge", "weight_metabolic_age", "Metabolic age in years"),
+    MetricSpec("physiqueRating", "weight_physique_rating", "Physique rating"),
+)
+
+SLEEP = (
+    MetricSpec("sleepTimeSeconds", "sleep_time_sec", "Total sleep time in seconds"),
+    MetricSpec("deepSleepSeconds", "sleep_deep_sec", "Deep sleep time in seconds"),
+    MetricSpec("lightSleepSeconds", "sleep_light_sec", "Light sleep time in seconds"),
+    MetricSpec("awakeSleepSeconds", "sleep_awake_sec", "Sleep awake time in seconds"),
+    # 0 on watches that cannot tell REM sleep apart
+    MetricSpec(
+        "remSleepSeconds", "sleep_rem_sec", "REM sleep time in seconds", skip_zero=True
+    ),
+)
+
+# computed from the FIT file of an activity, see activity_files.py. the
+# keys are those of activity_files.analyze()
+QUANTILES = ("0.1", "0.25", "0.5", "0.75", "0.9")
+
+ACTIVITY = (
+    MetricSpec(
+        "elapsedSeconds",
+        "activity_elapsed_seconds",
+        "Seconds from the first to the last record of an activity",
+    ),
+    MetricSpec(
+        "movingSeconds", "activity_moving_seconds", "Seconds moving during an activity"
+    ),
+    MetricSpec(
+        "averageHeartRate",
+        "activity_heart_rate_avg",
+        "Time weighted average heart rate of an activity",
+    ),
+    MetricSpec(
+        "averageCadence",
+        "activity_cadence_avg",
+        "Time weighted average cadence of an activity while moving",
+    ),
+    MetricSpec(
+        "averagePower",
+        "activity_power_avg_watts",
+        "Time weighted average power of an activity",
+    ),
+    MetricSpec(
+        "normalizedPower",
+        "activity_normalized_power_watts",
+        "Normalized power of an activity, from 30 second rolling averages",
+    ),
+    MetricSpec(
+        "elevationGain",
+        "activity_elevation_gain_meters",
+        "Elevation gained during an activity",
+    ),
+    MetricSpec(
+        "elevationLoss",
+        "activity_elevation_loss_meters",
+        "Elevation lost during an activity",
+    ),
+)
+ACTIVITY += tuple(
+    MetricSpec(
+        "heartRateZone{}Seconds".format(zone),
+        "activity_heart_rate_zone_seconds",
+        "Seconds per heart rate zone during an activity",
+        labels={"zone": str(zone)},
+    )
+    for zone in range(1, 6)
+)
+ACTIVITY += tuple(
+    MetricSpec(
+        "pace:{}".format(quantile),
+        "activity_pace_seconds_per_km",
+        "Quantiles of the pace while moving during an activity",
+        labels={"quantile": quantile},
+    )
+    for quantile in QUANTILES
+)
+ACTIVITY += tuple(
+    MetricSpec(
+        "power:{}".format(quantile),
+        "activity_power_watts",
+        "Quantiles of the power during an activity",
+        labels={"quantile": quantile},
+    )
+    for quantile in QUANTILES
+)
+
+# maintained by trends.py from the daily values of these metrics
+TRENDS = ("resting_heart_rate", "steps", "sleep", "weight")
+TREND_WINDOWS = (7, 28, 90)
+
+TREND = tuple(
+    MetricSpec(
+        "{}:{}d".format(trend, window),
+        "trend_avg",
+        "Average of a metric over the days up to its latest value",
+        labels={"trend": trend, "window": "{}d".format(window)},
+    )
+    for trend in TRENDS
+    for window in TREND_WINDOWS
+)
+TREND += tuple(
+    MetricSpec(
+        "{}:deviation".format(trend),
+        "trend_baseline_deviation",
+        "Latest value of a metric minus its 28 day average",
+        labels={"trend": trend},
+    )
+    for trend in TRENDS
+)
+TREND += tuple(
+    MetricSpec(
+        "{}:zscore".format(trend),
+        "trend_baseline_zscore",
+        "Deviation of the latest value of a metric in 28 day standard deviations",
+        labels={"trend": trend},
+    )
+    for trend in TRENDS
+)
+TREND += (
+    MetricSpec(
+        "load:acute",
+        "training_load_acute",
+        "Exponentially weighted 7 day training load, in intensity minutes",
+    ),
+    MetricSpec(
+        "load:chronic",
+        "training_load_chronic",
+        "Exponentially weighted 28 day training load, in intensity minutes",
+    ),
+    MetricSpec(
+        "load:ratio",
+        "training_load_ratio",
+        "Acute to chronic training load ratio",
+    ),
+)
+
+# payload field with the time a group's data was recorded, sent as the
+# sample timestamp by sinks that keep one. epoch milliseconds, or an ISO
+# string in UTC like "2019-01-29T02:45:10.912"
+TIMESTAMPS = {
+    "summary": "lastSyncTimestampGMT",
+    "weight": "date",
+    "sleep": "sleepEndTimestampGMT",
+}
+
+SPECS = {
+    "summary": SUMMARY,
+    "weight": WEIGHT,
+    "sleep": SLEEP,
+    "activity": ACTIVITY,
+    "trends": TREND,
+}
+
+# labels taken from the payload instead of the spec, on every metric of a
+# group. an activity's metrics are one set of series per activity
+LABELS = {
+    "activity": ("activity_id", "activity_type"),
+}
@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import traceback
+
+from collections import OrderedDict
+
+from state_store import state_path
+
+
+class Outbox():
+    '''
+    Append-only journal of outgoing deliveries (metric pushes, grafana
+    annotations). Every delivery is recorded before it is sent and acked
+    once the receiver took it, whatever is still pending after an outage
+    is replayed later. Entries share a key when a newer one makes the
+    older one pointless (the same source of the same user, the same
+    activity), so a long outage keeps one entry per key instead of one per
+    run. The journal is rewritten with only the pending entries once it
+    is mostly acks, and holds at most OUTBOX_MAX_ENTRIES entries.
+
+    Journal lines:
+    {"op": "add", "id": 12, "kind": "metrics", "key": "metrics:summary:jane", "payload": {...}}
+    {"op": "ack", "id": 12}
+    '''
+    def __init__(self, logger, name='outbox.jsonl'):
+        self.logger = logger
+        self.path = state_path(name)
+        self.max_entries = int(os.environ.get('OUTBOX_MAX_ENTRIES', '5000'))
+        self.lock = threading.RLock()
+        self.pending = OrderedDict()
+        self.ids = {}
+        self.next_id = 1
+        self.lines = 0
+        self.load()
+        self.journal = open(self.path, 'a')
+        if self.lines > 2 * len(self.pending) + 100:
+            self.compact()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line can be cut short by a crash
+                        continue
+                    self.lines += 1
+                    self.next_id = max(self.next_id, record['id'] + 1)
+                    if record['op'] == 'add':
+                        self.insert(record)
+                    else:
+                        self.remove(record['id'])
+        except OSError:
+            pass
+        if self.pending:
+            self.logger.info('{} undelivered entries in the outbox'.format(len(self.pending)))
+
+    def write(self, record):
+        self.journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.lines += 1
+
+    def insert(self, record):
+        # a newer entry with the same key replaces the older one
+        older = self.pending.pop(record['key'], None)
+        if older is not None:
+            del self.ids[older['id']]
+        self.pending[record['key']] = record
+        self.ids[record['id']] = record['key']
+
+    def remove(self, entry_id):
+        key = self.ids.pop(entry_id, None)
+        if key is None:
+            return False
+        del self.pending[key]
+        return True
+
+    def add(self, kind, key, payload):
+        '''
+        Record a delivery before it is sent, returns its id for ack()
+        '''
+        with self.lock:
+            record = {'op': 'add', 'id': self.next_id, 'kind': kind,
+                      'key': '{}:{}'.format(kind, key), 'payload': payload}
+            self.next_id += 1
+            self.write(record)
+            self.insert(record)
+            while len(self.pending) > self.max_entries:
+                dropped = next(iter(self.pending.values()))
+                self.remove(dropped['id'])
+                self.write({'op': 'ack', 'id': dropped['id']})
+                self.logger.error('Outbox is full, dropped {}'.format(dropped['key']))
+            return record['id']
+
+    def ack(self, entry_id):
+        with self.lock:
+            if not self.remove(entry_id):
+                # superseded by a newer entry or dropped, nothing to ack
+                return
+            self.write({'op': 'ack', 'id': entry_id})
+            if self.lines > 2 * len(self.pending) + 100:
+                self.compact()
+
+    def compact(self):
+        with self.lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                for record in self.pending.values():
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal.close()
+            os.replace(tmp, self.path)
+            self.journal = open(self.path, 'a')
+            self.lines = len(self.pending)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def entries(self, kind):
+        with self.lock:
+            return [record for record in self.pending.values() if record['kind'] == kind]
+
+    def replay(self, handlers):
+        '''
+        Hand the pending entries of each kind to handlers[kind], which
+        delivers them (batched as it sees fit) and returns the ids it
+        delivered. Returns the number of entries delivered.
+        '''
+        delivered = 0
+        for kind, handler in handlers.items():
+            entries = self.entries(kind)
+            if not entries:
+                continue
+            self.logger.info('Replaying {} undelivered {} entries ...'.format(len(entries), kind))
+            try:
+                ids = handler(entries)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                continue
+            for entry_id in ids:
+                self.ack(entry_id)
+            delivered += len(ids)
+        return delivered
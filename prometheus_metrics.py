@@ -1,194 +1,351 @@
 import datetime
-import os
-import pytz
+import time
+import traceback
 
-from prometheus_client import CollectorRegistry, Gauge, pushadd_to_gateway
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import Instrumentation
+from leases import instance_name
+from metric_specs import LABELS, SPECS, TIMESTAMPS
+from samples import SampleBatch
+from sinks import load_sinks
+from startup import lazy_import
+
+
+def recorded_at(group, data):
+    """
+    When a group's payload was recorded upstream, in milliseconds since
+    epoch, never later than now
+    """
+    now = int(time.time() * 1000)
+    value = data.get(TIMESTAMPS.get(group))
+    if isinstance(value, str):
+        try:
+            parsed = datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+        except ValueError:
+            return now
+        value = int(parsed.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    if not isinstance(value, (int, float)) or value <= 0:
+        return now
+    return min(int(value), now)
 
 
 class PrometheusMetrics:
-    def __init__(self, logger):
+    def __init__(self, logger, outbox=None):
         self.logger = logger
-        self.registry = CollectorRegistry()
-        self.pushgateway = os.environ.get("PUSHGATEWAY", "localhost:9091")
-        self.job_name = os.environ.get("JOB_NAME", "healthstats")
-        self.timezone = os.environ.get("TIMEZONE", "UTC")
-
-    def summary(self, data):
-        self._heart_rate(data)
-        self._intensity_minutes(data)
-        self._steps(data)
-        self._floors(data)
-        self._calories(data)
-
-    def weight(self, data):
-        if (
-            data.get("weight") is None
-            or data.get("weight") == 0
-            or data.get("bodyFat") is None
-            or data.get("boneMass") is None
-            or data.get("bmi") is None
-            or data.get("bodyWater") is None
-            or data.get("muscleMass") is None
-        ):
-            return
+        self.outbox = outbox
+        # one registry per data source, pushed on its own, and one for the
+        # collector's metrics. self.registry sees all of them, for /metrics
+        client = lazy_import("prometheus_client")
+        self.registries = {
+            group: client.CollectorRegistry() for group in list(SPECS) + ["collector"]
+        }
+        self.registry = RegistryUnion(self.registries.values())
+        self.gauges = {}
+        self.labelnames = {}
+        self.groups = {}
+        self.extractors = {}
+        self.updated = set()
+        self.timestamps = {}
+        # where published metrics go, see sinks.py. each publish maps the
+        # registry to samples once and hands them to every sink at once
+        self.sinks = load_sinks(logger)
+        self.pool = None
+        if len(self.sinks) > 1:
+            self.pool = ThreadPoolExecutor(max_workers=len(self.sinks))
+        # set when accounts are sharded among replicas, each pushes its own
+        self.instance = instance_name()
+        for group, specs in SPECS.items():
+            self.compile(group, specs)
+        self.instrumentation = Instrumentation(self.registries["collector"])
 
-        # create metrics
-        weight_total = self.gauge("weight_total", "Body weight in KG")
-        weight_body_fat = self.gauge("weight_body_fat", "Body fat in %")
-        weight_bone_mass = self.gauge("weight_bone_mass", "Bone mass in KG")
-        weight_bmi = self.gauge("weight_bmi", "BMI")
-        weight_body_water = self.gauge("weight_body_water", "Body water in %")
-        weight_muscle_mass = self.gauge("weight_muscle_mass", "Muscle mass in KG")
-
-        # set metrics values
-        weight_total.set(data["weight"] / 1000.0)
-        weight_body_fat.set(data["bodyFat"])
-        weight_bone_mass.set(data["boneMass"] / 1000.0)
-        weight_bmi.set(data["bmi"])
-        weight_body_water.set(data["bodyWater"])
-        weight_muscle_mass.set(data["muscleMass"] / 1000.0)
-
-    def _heart_rate(self, data):
-        if (
-            data.get("restingHeartRate") is None
-            or data.get("minHeartRate") is None
-            or data.get("maxHeartRate") is None
-        ):
-            return
+    def compile(self, group, specs):
+        """
+        Turn metric specs into (key, scale, skip_zero, gauge, labels)
+        extractors. Metric families are registered once here and reused by
+        every run, fields sharing a name share one family.
+        """
+        extractors = []
+        for spec in specs:
+            if spec.name not in self.gauges:
+                labelnames = (
+                    ["user"] + sorted(spec.labels) + list(LABELS.get(group, ()))
+                )
+                self.gauges[spec.name] = lazy_import("prometheus_client").Gauge(
+                    spec.name,
+                    spec.documentation,
+                    labelnames,
+                    registry=self.registries[group],
+                )
+                self.labelnames[spec.name] = labelnames
+            self.groups.setdefault(group, set()).add(spec.name)
+            extractors.append(
+                (
+                    spec.key,
+                    spec.scale,
+                    spec.skip_zero,
+                    self.gauges[spec.name],
+                    spec.labels,
+                )
+            )
+        self.extractors[group] = extractors
 
-        # create metrics
-        resting_heart_rate = self.gauge("resting_heart_rate", "Resting heart rate")
-        heart_rate_resting = self.gauge("heart_rate_resting", "Resting heart rate")
-        heart_rate_min = self.gauge("heart_rate_min", "Minimum heart rate")
-        heart_rate_max = self.gauge("heart_rate_max", "Maximum heart rate")
-
-        # set metrics values
-        resting_heart_rate.set(data["restingHeartRate"])
-        heart_rate_resting.set(data["restingHeartRate"])
-        heart_rate_min.set(data["minHeartRate"])
-        heart_rate_max.set(data["maxHeartRate"])
-
-    def _steps(self, data):
-        if (
-            data.get("totalSteps") is None
-            or data.get("dailyStepGoal") is None
-            or data.get("totalDistanceMeters") is None
-            or data.get("activeSeconds") is None
-            or data.get("sedentarySeconds") is None
-        ):
-            return
+    def apply(self, group, data, user, labels={}):
+        # a missing field only drops its own metric. labels holds the
+        # values of the group's LABELS
+        for key, scale, skip_zero, gauge, static in self.extractors[group]:
+            value = data.get(key)
+            if value is None or (skip_zero and value == 0):
+                continue
+            gauge.labels(user=user, **static, **labels).set(value * scale)
+            self.updated.add((group, user))
+        if (group, user) in self.updated:
+            self.timestamps[(group, user)] = recorded_at(group, data)
 
-        # create metrics
-        steps = self.gauge("steps", "Total steps")
-        steps_daily_goal = self.gauge("steps_daily_goal", "Daily step goal")
-        distance_meters = self.gauge("distance_meters", "Total distance in meters")
-        active_seconds = self.gauge("active_seconds", "Seconds in movement")
-        sedentary_seconds = self.gauge(
-            "sedentary_seconds", "Seconds in sedentary position"
-        )
-
-        # set metrics values
-        steps.set(data["totalSteps"])
-        steps_daily_goal.set(data["dailyStepGoal"])
-        distance_meters.set(data["totalDistanceMeters"])
-        active_seconds.set(data["activeSeconds"])
-        sedentary_seconds.set(data["sedentarySeconds"])
-
-    def _calories(self, data):
-        if (
-            data.get("totalKilocalories") is None
-            or data.get("activeKilocalories") is None
-            or data.get("bmrKilocalories") is None
-        ):
-            return
+    def summary(self, data, user):
+        self.apply("summary", data, user)
 
-        # create metrics
-        calories = self.gauge("calories", "Total calories")
-        calories_active = self.gauge("calories_active", "Active calories")
-        calories_resting = self.gauge("calories_resting", "Resting calories")
-
-        # set metrics values
-        calories.set(data["totalKilocalories"])
-        calories_active.set(data["activeKilocalories"])
-        calories_resting.set(data["bmrKilocalories"])
-
-    def _intensity_minutes(self, data):
-        if (
-            data.get("moderateIntensityMinutes") is None
-            or data.get("vigorousIntensityMinutes") is None
-        ):
-            return
+    def weight(self, data, user):
+        self.apply("weight", data, user)
 
-        # create metrics
-        intensity_minutes_moderate = self.gauge(
-            "intensity_minutes_moderate", "Minutes in moderate intensity activities"
-        )
-        intensity_minutes_vigorous = self.gauge(
-            "intensity_minutes_vigorous", "Minutes in vigorous intensity activities"
-        )
-
-        # set metrics values
-        intensity_minutes_moderate.set(data["moderateIntensityMinutes"])
-        intensity_minutes_vigorous.set(data["vigorousIntensityMinutes"])
-
-    def _floors(self, data):
-        if (
-            data.get("floorsAscended") is None
-            or data.get("floorsAscendedInMeters") is None
-            or data.get("floorsDescended") is None
-            or data.get("floorsDescendedInMeters") is None
-        ):
-            return
+    def sleep(self, data, user):
+        # today's sleep is only downloaded in the afternoon, when it is
+        # complete, see the sleep SyncPolicy
+        self.apply("sleep", data, user)
+
+    def activities(self, user, activities):
+        """
+        Replace the activity metrics of a user with those of `activities`,
+        the analytics of the newest activities from ActivityFiles
+        """
+        self.forget("activity", user)
+        for activity in activities:
+            labels = {
+                "activity_id": str(activity["id"]),
+                "activity_type": activity["type"],
+            }
+            self.apply("activity", activity["metrics"], user, labels)
+
+    def forget(self, group, user):
+        """
+        Remove every series of one group's metrics of one user
+        """
+        for name in self.groups.get(group, ()):
+            gauge = self.gauges[name]
+            stale = [
+                tuple(sample.labels[label] for label in self.labelnames[name])
+                for family in gauge.collect()
+                for sample in family.samples
+                if sample.labels.get("user") == user
+            ]
+            for labelvalues in stale:
+                gauge.remove(*labelvalues)
+
+    def values(self, group, user):
+        """
+        Yield (name, labels, value) for the current values of one group's
+        metrics of one user
+        """
+        for name in sorted(self.groups.get(group, ())):
+            for family in self.gauges[name].collect():
+                for sample in family.samples:
+                    if sample.labels.get("user") == user:
+                        yield sample.name, sample.labels, sample.value
+
+    def samples(self, batch, timestamp):
+        """
+        Copy the current value of every metric into a SampleBatch,
+        stamped with timestamp (milliseconds since epoch)
+        """
+        for family in self.registry.collect():
+            if family.name not in self.gauges:
+                continue
+            for sample in family.samples:
+                batch.add(
+                    sample.name,
+                    family.documentation,
+                    family.type,
+                    sample.labels,
+                    sample.value,
+                    timestamp,
+                )
 
-        # create metrics
-        floors_ascended = self.gauge("floors_ascended", "Floors ascended")
-        floors_ascended_meters = self.gauge(
-            "floors_ascended_meters", "Floors ascended in meters"
-        )
-        floors_descended = self.gauge("floors_descended", "Floors descended")
-        floors_descended_meters = self.gauge(
-            "floors_descended_meters", "Floors descended in meters"
-        )
-
-        # set metrics values
-        floors_ascended.set(data["floorsAscended"])
-        floors_ascended_meters.set(data["floorsAscendedInMeters"])
-        floors_descended.set(data["floorsDescended"])
-        floors_descended_meters.set(data["floorsDescendedInMeters"])
-
-    def sleep(self, data):
-        utc = datetime.datetime.now()
-        now = pytz.timezone(self.timezone).fromutc(utc)
-        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        duration = (now - midnight).seconds
-
-        if duration < 43200:
-            # only sync when the day past 12 hours
-            # 43200 = 3600 * 12
+    def publish(self, group, user=None):
+        """
+        Publish one data source of one user to every sink, under the
+        grouping key source=<group>,user=<user>, so it replaces only its
+        own earlier push and a failure leaves the other sources alone. The
+        "collector" group, without a user, holds the collector's own
+        metrics. Samples carry the time their payload was recorded, for
+        the sinks that keep timestamps. Every sink's delivery is recorded
+        in the outbox first, and stays there for a later replay if it fails.
+        """
+        grouping_key = {"source": group}
+        registry = self.registries[group]
+        if user is not None:
+            grouping_key["user"] = user
+            pairs = {(name, user) for name in self.groups.get(group, ())}
+
+            def keep(family, sample):
+                return (family.name, sample.labels.get("user")) in pairs
+
+            registry = RegistrySubset(registry, keep)
+        if self.instance is not None:
+            grouping_key["instance"] = self.instance
+
+        batch = self.timestamped(registry)
+        payload = {"grouping_key": grouping_key, "samples": batch_samples(batch)}
+        key = ":".join(grouping_key.values())
+        stamped = "{}:{}".format(key, self.timestamps.get((group, user), ""))
+        deliveries = [
+            (sink, batch, stamped if sink.timestamps else key, payload)
+            for sink in self.sinks
+        ]
+        if self.pool is None:
+            for delivery in deliveries:
+                self.deliver(*delivery)
             return
+        futures = [self.pool.submit(self.deliver, *delivery) for delivery in deliveries]
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def deliver(self, sink, batch, key, payload):
+        # samples with other timestamps are other data points, for the sinks
+        # keeping timestamps only a resend of the same ones replaces an entry
+        entry = None
+        if self.outbox is not None:
+            entry = self.outbox.add(
+                "metrics", "{}:{}".format(sink.name, key), dict(payload, sink=sink.name)
+            )
+        sink.write(payload["grouping_key"], batch)
+        if entry is not None:
+            self.outbox.ack(entry)
 
-        if (
-            data.get("sleepTimeSeconds") is None
-            or data.get("deepSleepSeconds") is None
-            or data.get("lightSleepSeconds") is None
-            or data.get("awakeSleepSeconds") is None
-        ):
+    def replay(self, entries):
+        """
+        Outbox handler: deliver pending metric entries, those of the sinks
+        keeping timestamps coalesced into one batch per sink, and return the
+        ids that went through. Entries of sinks that are not configured
+        anymore are dropped.
+        """
+        delivered = []
+        sinks = {sink.name: sink for sink in self.sinks}
+        pending = {}
+        for entry in entries:
+            payload = entry["payload"]
+            # entries journaled before there were several sinks
+            name = payload.get("sink") or (
+                "remote_write" if "samples" in payload else "pushgateway"
+            )
+            if name not in sinks:
+                self.logger.info(
+                    "Dropping {}, sink {} is not configured".format(entry["key"], name)
+                )
+                delivered.append(entry["id"])
+                continue
+            pending.setdefault(name, []).append(entry)
+        for name, sink_entries in pending.items():
+            sink = sinks[name]
+            if sink.timestamps:
+                groups = [sink_entries]
+            else:
+                groups = [[entry] for entry in sink_entries]
+            for group in groups:
+                try:
+                    self.resend(sink, group)
+                    delivered.extend(entry["id"] for entry in group)
+                except Exception:
+                    self.logger.error(traceback.format_exc())
+        return delivered
+
+    def resend(self, sink, entries):
+        payload = entries[0]["payload"]
+        if "body" in payload:
+            # a pushgateway body journaled before there were several sinks
+            sink.post(payload["grouping_key"], payload["body"])
             return
+        batch = SampleBatch()
+        for entry in entries:
+            for sample in entry["payload"]["samples"]:
+                batch.add(*sample)
+        sink.write(payload.get("grouping_key", {}), batch)
+
+    def timestamped(self, registry):
+        """
+        Samples of a registry stamped with the time their payload was
+        recorded, the collector's own metrics with now
+        """
+        now = int(time.time() * 1000)
+        owner = {name: group for group, names in self.groups.items() for name in names}
+        batch = SampleBatch()
+        for family in registry.collect():
+            group = owner.get(family.name)
+            for sample in family.samples:
+                timestamp = self.timestamps.get((group, sample.labels.get("user")), now)
+                # a histogram's _bucket, _sum and _count samples become
+                # families of their own, which are not histograms
+                metric_type = family.type
+                if sample.name not in (family.name, family.name + "_total"):
+                    metric_type = "untyped"
+                batch.add(
+                    sample.name,
+                    family.documentation,
+                    metric_type,
+                    sample.labels,
+                    sample.value,
+                    timestamp,
+                )
+        return batch
+
+
+def batch_samples(batch):
+    return [
+        [name, family["documentation"], family["type"], labels, value, timestamp]
+        for name, family in batch.families.items()
+        for labels, value, timestamp in family["samples"]
+    ]
+
+
+class RegistryUnion:
+    """
+    Several registries behind one, served on /metrics
+    """
+
+    def __init__(self, registries):
+        self.registries = list(registries)
+
+    def collect(self):
+        for registry in self.registries:
+            yield from registry.collect()
+
+    def restricted_registry(self, names):
+        """
+        Only the samples named in names, for /metrics?name[]=..., like
+        CollectorRegistry.restricted_registry
+        """
+        names = set(names)
+        return RegistrySubset(self, lambda family, sample: sample.name in names)
 
-        # create metrics
-        sleep_time_sec = self.gauge("sleep_time_sec", "Total sleep time in seconds")
-        sleep_deep_sec = self.gauge("sleep_deep_sec", "Deep sleep time in seconds")
-        sleep_light_sec = self.gauge("sleep_light_sec", "Light sleep time in seconds")
-        sleep_awake_sec = self.gauge("sleep_awake_sec", "Sleep awake time in seconds")
 
-        # set metrics values
-        sleep_time_sec.set(data["sleepTimeSeconds"])
-        sleep_deep_sec.set(data["deepSleepSeconds"])
-        sleep_light_sec.set(data["lightSleepSeconds"])
-        sleep_awake_sec.set(data["awakeSleepSeconds"])
+class RegistrySubset:
+    """
+    The samples of a registry for which keep(family, sample) is true,
+    leaving out the families without any
+    """
 
-    def gauge(self, name, documentation):
-        return Gauge(name, documentation, registry=self.registry)
+    def __init__(self, registry, keep):
+        self.registry = registry
+        self.keep = keep
 
-    def publish(self):
-        pushadd_to_gateway(self.pushgateway, job=self.job_name, registry=self.registry)
+    def collect(self):
+        for family in self.registry.collect():
+            samples = [sample for sample in family.samples if self.keep(family, sample)]
+            if not samples:
+                continue
+            subset = lazy_import("prometheus_client.metrics_core").Metric(
+                family.name, family.documentation, family.type
+            )
+            subset.samples = samples
+            yield subset
@@ -0,0 +1,210 @@
+import os
+import random
+import struct
+import time
+
+from leases import instance_name
+from startup import lazy_import
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, payload):
+    # length-delimited field (wire type 2)
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def encode_timeseries(labels, timestamps, values):
+    '''
+    prometheus.TimeSeries: repeated Label labels = 1, repeated Sample samples = 2,
+    with Label {string name = 1; string value = 2} and
+    Sample {double value = 1; int64 timestamp = 2}
+    '''
+    parts = []
+    for name in sorted(labels):
+        parts.append(field(1, field(1, name.encode('utf-8')) +
+                              field(2, str(labels[name]).encode('utf-8'))))
+    for timestamp, value in zip(timestamps, values):
+        sample = b'\x09' + struct.pack('<d', float(value)) + b'\x10' + varint(int(timestamp))
+        parts.append(field(2, sample))
+    return b''.join(parts)
+
+
+def encode_write_request(timeseries):
+    '''
+    prometheus.WriteRequest: repeated TimeSeries timeseries = 1
+    '''
+    return b''.join(field(1, encode_timeseries(*series)) for series in timeseries)
+
+
+def snappy_compress(data):
+    '''
+    Snappy block format. Uses python-snappy when it is installed, otherwise
+    a small greedy compressor: literals plus copies found through a hash
+    of the next 4 bytes, which is plenty for the repetitive label strings
+    of a write request
+    '''
+    if snappy is not None:
+        return snappy.compress(data)
+    out = bytearray(varint(len(data)))
+    table = {}
+    literal_start = 0
+    i = 0
+    end = len(data) - 4
+    while i <= end:
+        key = data[i:i + 4]
+        candidate = table.get(key)
+        table[key] = i
+        if candidate is None or i - candidate > 0xffff:
+            i += 1
+            continue
+        length = 4
+        while i + length < len(data) and data[candidate + length] == data[i + length]:
+            length += 1
+        emit_literal(out, data[literal_start:i])
+        emit_copy(out, i - candidate, length)
+        i += length
+        literal_start = i
+    emit_literal(out, data[literal_start:])
+    return bytes(out)
+
+
+def emit_literal(out, literal):
+    while literal:
+        chunk, literal = literal[:65536], literal[65536:]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(n << 2)
+        elif n < 0x100:
+            out += bytes((60 << 2, n))
+        else:
+            out += bytes((61 << 2,)) + struct.pack('<H', n)
+        out += chunk
+
+
+def emit_copy(out, offset, length):
+    # copies with a 2 byte offset, at most 64 bytes each
+    while length > 0:
+        chunk = min(length, 64)
+        out += bytes(((chunk - 1) << 2 | 2,)) + struct.pack('<H', offset)
+        length -= chunk
+
+
+class RemoteWriteError(Exception):
+    pass
+
+
+class RemoteWrite():
+    '''
+    Sends timestamped samples to a Prometheus remote-write receiver
+    (Prometheus with --web.enable-remote-write-receiver, Mimir, Thanos,
+    VictoriaMetrics, ...) as snappy-compressed protobuf, in batches of at
+    most `batch_size` samples, retrying 429, 5xx and connection errors
+    with exponential backoff and jitter.
+    '''
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.url = os.environ.get('REMOTE_WRITE_URL', 'http://localhost:9090/api/v1/write')
+        self.batch_size = int(os.environ.get('REMOTE_WRITE_BATCH', '5000'))
+        self.retries = int(os.environ.get('REMOTE_WRITE_RETRIES', '4'))
+        self.backoff = float(os.environ.get('REMOTE_WRITE_BACKOFF', '1'))
+        # the labels the Pushgateway would have added
+        self.job_name = os.environ.get('JOB_NAME', 'healthstats')
+        self.instance = instance_name()
+        self.session = lazy_import('requests').Session()
+        self.session.headers.update({
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'User-Agent': 'healthstats-collector',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        })
+        username = os.environ.get('REMOTE_WRITE_USERNAME')
+        if username:
+            self.session.auth = (username, os.environ.get('REMOTE_WRITE_PASSWORD', ''))
+
+    def timeseries(self, batch):
+        '''
+        Yield (labels, timestamps, values) per series of a SampleBatch,
+        samples in timestamp order
+        '''
+        extra = {'job': self.job_name}
+        if self.instance is not None:
+            extra['instance'] = self.instance
+        for name, family in batch.families.items():
+            grouped = {}
+            for labels, value, timestamp in family['samples']:
+                key = tuple(sorted(labels.items()))
+                grouped.setdefault(key, []).append((timestamp, value))
+            for key, samples in grouped.items():
+                samples.sort()
+                yield (dict(key, __name__=name, **extra),
+                       [s[0] for s in samples], [s[1] for s in samples])
+            for labels, timestamps, values in family['series']:
+                yield dict(labels, __name__=name, **extra), timestamps, values
+
+    def chunks(self, batch):
+        chunk = []
+        size = 0
+        for labels, timestamps, values in self.timeseries(batch):
+            for start in range(0, len(timestamps), self.batch_size):
+                part = (labels, timestamps[start:start + self.batch_size],
+                        values[start:start + self.batch_size])
+                if chunk and size + len(part[1]) > self.batch_size:
+                    yield chunk
+                    chunk = []
+                    size = 0
+                chunk.append(part)
+                size += len(part[1])
+        if chunk:
+            yield chunk
+
+    def send(self, batch):
+        sent = 0
+        for chunk in self.chunks(batch):
+            self.post(snappy_compress(encode_write_request(chunk)))
+            sent += sum(len(timestamps) for _, timestamps, _ in chunk)
+        self.logger.info('Sent {} samples to {}'.format(sent, self.url))
+        return sent
+
+    def post(self, body):
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response = self.session.post(self.url, data=body, timeout=30)
+                if response.status_code < 300:
+                    return
+                error = '{} {}'.format(response.status_code, response.text[:200].strip())
+                if response.status_code == 400:
+                    # some samples were refused, e.g. out of order or too old
+                    # for the receiver, the rest were written. sending them
+                    # again would fail the same way
+                    self.logger.error('Remote write rejected samples: {}'.format(error))
+                    return
+                if response.status_code not in self.retry_statuses:
+                    raise RemoteWriteError('remote write failed: {}'.format(error))
+            except lazy_import('requests').exceptions.RequestException as e:
+                error = e
+            if attempt >= self.retries:
+                raise RemoteWriteError('remote write failed: {}'.format(error))
+            wait = random.uniform(0, self.backoff * 2 ** attempt)
+            self.logger.info('Retrying remote write in {:.1f} seconds after {}'.format(wait, error))
+            time.sleep(wait)
+            attempt += 1
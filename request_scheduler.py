@@ -0,0 +1,161 @@
+import email.utils
+import os
+import random
+import threading
+import time
+
+from startup import lazy_import
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker():
+    '''
+    Opens after `threshold` consecutive failures and fails fast until
+    `reset_timeout` seconds have passed, then lets one trial request
+    through (half-open) to decide whether to close again.
+    '''
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class RequestScheduler():
+    '''
+    Shared by every GarminConnect, so all accounts draw from one rate
+    budget: a token bucket for the overall request rate, a concurrency
+    limit and a circuit breaker per endpoint, and retries with
+    exponential backoff and full jitter that honor Retry-After.
+    '''
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.bucket = TokenBucket(float(os.environ.get('GARMIN_RATE', '2')),
+                                  float(os.environ.get('GARMIN_BURST', '4')))
+        self.endpoint_concurrency = int(os.environ.get('GARMIN_ENDPOINT_CONCURRENCY', '2'))
+        self.retries = int(os.environ.get('GARMIN_RETRIES', '4'))
+        self.backoff = float(os.environ.get('GARMIN_BACKOFF', '1'))
+        self.backoff_max = float(os.environ.get('GARMIN_BACKOFF_MAX', '60'))
+        self.breaker_threshold = int(os.environ.get('GARMIN_BREAKER_THRESHOLD', '5'))
+        self.breaker_reset = float(os.environ.get('GARMIN_BREAKER_RESET', '60'))
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.breakers = {}
+
+    def set_rate(self, rate):
+        '''
+        Replace the GARMIN_RATE budget for the rest of the process, 0 for
+        no limit, keeping GARMIN_BURST
+        '''
+        self.bucket = TokenBucket(rate, self.bucket.burst)
+
+    def limits(self, endpoint):
+        with self.lock:
+            if endpoint not in self.semaphores:
+                self.semaphores[endpoint] = threading.BoundedSemaphore(self.endpoint_concurrency)
+                self.breakers[endpoint] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self.semaphores[endpoint], self.breakers[endpoint]
+
+    def delay(self, attempt, response):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                when = email.utils.parsedate_to_datetime(retry_after)
+                if when is not None:
+                    return min(max(0.0, when.timestamp() - time.time()), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def execute(self, endpoint, send, on_retry=None):
+        '''
+        Calls send() until it returns a response that is not worth retrying,
+        or the retries run out, and returns the last response. Raises
+        CircuitOpenError without calling send() while the endpoint's
+        breaker is open.
+        '''
+        requests = lazy_import('requests')
+        semaphore, breaker = self.limits(endpoint)
+        if not breaker.allow():
+            raise CircuitOpenError('too many failures on {}, not calling it for now'.format(endpoint))
+
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            response = None
+            error = None
+            with semaphore:
+                try:
+                    response = send()
+                except requests.exceptions.RequestException as e:
+                    error = e
+
+            retryable = error is not None or response.status_code in self.retry_statuses
+            if not retryable:
+                breaker.success()
+                return response
+            if attempt >= self.retries:
+                breaker.failure()
+                if error is not None:
+                    raise error
+                return response
+
+            wait = self.delay(attempt, response)
+            self.logger.info('Retrying {} in {:.1f} seconds after {}'.format(
+                endpoint, wait, error or response.status_code))
+            if on_retry is not None:
+                on_retry(endpoint)
+            time.sleep(wait)
+            attempt += 1
@@ -0,0 +1,119 @@
+import os
+
+from collections import OrderedDict
+
+
+class SampleBatch():
+    '''
+    Timestamped samples grouped by metric family, for the outputs that can
+    carry real sample timestamps (unlike Pushgateway).
+    '''
+    def __init__(self):
+        self.families = OrderedDict()
+
+    def family(self, name, documentation, metric_type):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = {
+                'documentation': documentation,
+                'type': metric_type,
+                'samples': [],
+                'series': [],
+            }
+        return family
+
+    def add(self, name, documentation, metric_type, labels, value, timestamp):
+        '''
+        timestamp is in milliseconds since epoch
+        '''
+        family = self.family(name, documentation, metric_type)
+        family['samples'].append((dict(labels), value, timestamp))
+
+    def add_series(self, name, documentation, metric_type, labels, timestamps, values):
+        '''
+        Many samples of one series at once, as parallel timestamp (ms) and
+        value sequences, e.g. arrays, which are kept as they are instead of
+        being unpacked into one tuple per sample
+        '''
+        family = self.family(name, documentation, metric_type)
+        family['series'].append((dict(labels), timestamps, values))
+
+    def extend(self, other):
+        for name, family in other.families.items():
+            for labels, value, timestamp in family['samples']:
+                self.add(name, family['documentation'], family['type'], labels, value, timestamp)
+            for labels, timestamps, values in family['series']:
+                self.add_series(name, family['documentation'], family['type'], labels,
+                                timestamps, values)
+
+    def __len__(self):
+        return sum(len(family['samples']) + sum(len(series[1]) for series in family['series'])
+                   for family in self.families.values())
+
+
+def escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, escape(str(v))) for k, v in sorted(labels.items())
+    ) + '}'
+
+
+def iter_text(batch, labels=None):
+    '''
+    Yield the batch in the Prometheus text format, without timestamps, for
+    the outputs that only hold the latest value of each series (Pushgateway,
+    node_exporter textfiles). Of an array series only the last sample is
+    kept. labels are added to every sample.
+    '''
+    extra = labels or {}
+    for name, family in batch.families.items():
+        documentation = family['documentation'].replace('\\', r'\\').replace('\n', r'\n')
+        yield '# HELP {} {}\n'.format(name, documentation)
+        yield '# TYPE {} {}\n'.format(name, family['type'])
+        for sample_labels, value, _ in family['samples']:
+            yield '{}{} {!r}\n'.format(name, label_text(dict(sample_labels, **extra)), float(value))
+        for series_labels, timestamps, values in family['series']:
+            if len(values):
+                yield '{}{} {!r}\n'.format(name, label_text(dict(series_labels, **extra)),
+                                          float(values[-1]))
+
+
+def render_text(batch, labels=None):
+    return ''.join(iter_text(batch, labels))
+
+
+def iter_openmetrics(batch):
+    '''
+    Yield the batch in the OpenMetrics text format line by line, which
+    `promtool tsdb create-blocks-from openmetrics` can ingest.
+    '''
+    for name, family in batch.families.items():
+        yield '# HELP {} {}\n'.format(name, escape(family['documentation']))
+        yield '# TYPE {} {}\n'.format(name, family['type'])
+        for labels, value, timestamp in sorted(family['samples'], key=lambda s: s[2]):
+            yield '{}{} {} {:.3f}\n'.format(name, label_text(labels), float(value),
+                                            timestamp / 1000.0)
+        for labels, timestamps, values in family['series']:
+            prefix = name + label_text(labels)
+            for timestamp, value in zip(timestamps, values):
+                yield '{} {} {:.3f}\n'.format(prefix, float(value), timestamp / 1000.0)
+    yield '# EOF\n'
+
+
+def render_openmetrics(batch):
+    return ''.join(iter_openmetrics(batch))
+
+
+def write_openmetrics(path, batch):
+    '''
+    Stream the batch to an OpenMetrics file, swapped in atomically
+    '''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(iter_openmetrics(batch))
+    os.replace(tmp, path)
@@ -0,0 +1,50 @@
+import hashlib
+import os
+import time
+
+from state_store import load_json, save_json, state_path
+
+
+class SessionCache():
+    def __init__(self, logger, username):
+        self.logger = logger
+        self.ttl = int(os.environ.get('SESSION_CACHE_TTL', '43200'))
+        key = hashlib.sha1((username or '').encode('utf-8')).hexdigest()[:12]
+        self.path = state_path('session-{}.json'.format(key))
+
+    def load(self):
+        '''
+        {
+            "expires": 1548709510.0,
+            "cookies": [{"name": "SESSIONID", "value": "...", "domain": "connect.garmin.com", ...}],
+            "profile": {"display_name": "...", "english_units": false, "full_name": "..."}
+        }
+        '''
+        if self.ttl <= 0:
+            return None
+        cache = load_json(self.path)
+        if not cache or cache.get('expires', 0) <= time.time():
+            return None
+        return cache
+
+    def save(self, cookies, profile):
+        if self.ttl <= 0:
+            return
+        save_json(self.path, {
+            'expires': time.time() + self.ttl,
+            'cookies': [{
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'secure': cookie.secure,
+                'expires': cookie.expires,
+            } for cookie in cookies],
+            'profile': profile,
+        }, mode=0o600)
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,211 @@
+import base64
+import math
+import os
+import re
+import tempfile
+import traceback
+
+from urllib.parse import quote_plus
+
+from leases import instance_name
+from remote_write import RemoteWrite
+from samples import render_text
+from startup import lazy_import
+from state_store import state_path
+
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def grouping_path(grouping_key):
+    '''
+    Pushgateway url path for a grouping key, values that would not fit
+    in a path segment are base64 encoded
+    '''
+    parts = []
+    for key, value in grouping_key.items():
+        if value == '' or '/' in value:
+            encoded = base64.urlsafe_b64encode(value.encode('utf-8')).decode('utf-8')
+            parts.append('{}@base64/{}'.format(key, encoded or '='))
+        else:
+            parts.append('{}/{}'.format(key, quote_plus(value)))
+    return '/'.join(parts)
+
+
+class PushgatewaySink():
+    '''
+    Pushes the latest values of a grouping key to the Pushgateway at
+    PUSHGATEWAY, replacing only that grouping key's earlier push
+    '''
+    name = 'pushgateway'
+    timestamps = False
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.url = os.environ.get('PUSHGATEWAY', 'localhost:9091')
+        if '://' not in self.url:
+            self.url = 'http://' + self.url
+        self.job_name = os.environ.get('JOB_NAME', 'healthstats')
+        self.session = lazy_import('requests').Session()
+
+    def write(self, grouping_key, batch):
+        self.post(grouping_key, render_text(batch))
+
+    def post(self, grouping_key, body):
+        # POST, like pushadd_to_gateway: replaces only the metrics it sends
+        url = '{}/metrics/job/{}/{}'.format(
+            self.url, quote_plus(self.job_name), grouping_path(grouping_key))
+        response = self.session.post(url, data=body.encode('utf-8'),
+                                     headers={'Content-Type': CONTENT_TYPE_TEXT}, timeout=30)
+        response.raise_for_status()
+
+
+class TextfileSink():
+    '''
+    Writes the latest values of each grouping key to its own *.prom file
+    in TEXTFILE_DIR, for the textfile collector of a node_exporter on the
+    same host. Files are written under a temporary name and renamed over
+    the old one, so node_exporter never reads half a file. The grouping
+    key is added as labels, like the Pushgateway does.
+    '''
+    name = 'textfile'
+    timestamps = False
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.directory = os.environ.get('TEXTFILE_DIR') or state_path('textfile')
+
+    def path(self, grouping_key):
+        name = '_'.join(['healthstats'] + list(grouping_key.values()))
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.prom')
+
+    def write(self, grouping_key, batch):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(grouping_key)
+        # in the same directory, a rename across file systems is no rename
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(render_text(batch, grouping_key))
+            # node_exporter usually runs as another user
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def escape_key(value):
+    return re.sub(r'([,= ])', r'\\\1', str(value))
+
+
+class InfluxDBSink():
+    '''
+    Writes timestamped samples to InfluxDB as line protocol, one
+    measurement per metric with the labels as tags and the sample in the
+    field "value", in requests of at most INFLUXDB_BATCH lines over one
+    pooled connection. With INFLUXDB_ORG set the v2 API (/api/v2/write,
+    INFLUXDB_BUCKET), otherwise the v1 one (/write, INFLUXDB_BUCKET as the
+    database).
+    '''
+    name = 'influxdb'
+    timestamps = True
+
+    def __init__(self, logger):
+        self.logger = logger
+        url = os.environ.get('INFLUXDB_URL', 'http://localhost:8086').rstrip('/')
+        bucket = os.environ.get('INFLUXDB_BUCKET', 'healthstats')
+        org = os.environ.get('INFLUXDB_ORG')
+        if org:
+            self.url = url + '/api/v2/write'
+            self.params = {'org': org, 'bucket': bucket, 'precision': 'ms'}
+        else:
+            self.url = url + '/write'
+            self.params = {'db': bucket, 'precision': 'ms'}
+        self.batch_size = int(os.environ.get('INFLUXDB_BATCH', '5000'))
+        self.instance = instance_name()
+        self.session = lazy_import('requests').Session()
+        self.session.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        token = os.environ.get('INFLUXDB_TOKEN')
+        if token:
+            self.session.headers['Authorization'] = 'Token ' + token
+
+    def lines(self, batch):
+        extra = {'instance': self.instance} if self.instance is not None else {}
+        for name, family in batch.families.items():
+            measurement = escape_key(name)
+            for labels, value, timestamp in family['samples']:
+                yield self.line(measurement, dict(labels, **extra), value, timestamp)
+            for labels, timestamps, values in family['series']:
+                labels = dict(labels, **extra)
+                for timestamp, value in zip(timestamps, values):
+                    yield self.line(measurement, labels, value, timestamp)
+
+    def line(self, measurement, labels, value, timestamp):
+        value = float(value)
+        if not math.isfinite(value):
+            # line protocol has no NaN or infinity
+            return None
+        tags = ''.join(',{}={}'.format(escape_key(k), escape_key(v))
+                       for k, v in sorted(labels.items()) if v != '')
+        return '{}{} value={!r} {}'.format(measurement, tags, value, int(timestamp))
+
+    def write(self, grouping_key, batch):
+        chunk = []
+        sent = 0
+        for line in self.lines(batch):
+            if line is None:
+                continue
+            chunk.append(line)
+            if len(chunk) >= self.batch_size:
+                self.post(chunk)
+                sent += len(chunk)
+                chunk = []
+        if chunk:
+            self.post(chunk)
+            sent += len(chunk)
+        self.logger.info('Wrote {} samples to {}'.format(sent, self.url))
+
+    def post(self, lines):
+        response = self.session.post(self.url, params=self.params,
+                                     data='\n'.join(lines).encode('utf-8'), timeout=30)
+        response.raise_for_status()
+
+
+class RemoteWriteSink():
+    '''
+    Sends timestamped samples to a Prometheus remote-write receiver, see
+    RemoteWrite
+    '''
+    name = 'remote_write'
+    timestamps = True
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.remote_write = RemoteWrite(logger)
+        self.url = self.remote_write.url
+
+    def write(self, grouping_key, batch):
+        self.remote_write.send(batch)
+
+
+SINKS = {sink.name: sink for sink in (PushgatewaySink, TextfileSink, InfluxDBSink, RemoteWriteSink)}
+
+
+def load_sinks(logger):
+    '''
+    The sinks named in METRICS_SINK, comma separated
+    '''
+    sinks = []
+    for name in os.environ.get('METRICS_SINK', 'pushgateway').split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name not in SINKS:
+            logger.error('Unknown metrics sink {}, expected one of {}'.format(
+                name, ', '.join(sorted(SINKS))))
+            continue
+        try:
+            sinks.append(SINKS[name](logger))
+        except Exception:
+            logger.error(traceback.format_exc())
+    return sinks
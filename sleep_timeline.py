@@ -0,0 +1,255 @@
+import calendar
+import datetime
+import os
+import struct
+import sys
+import threading
+
+from array import array
+from functools import lru_cache
+
+from samples import SampleBatch, write_openmetrics
+
+# garmin's activityLevel of a sleep level segment
+LEVELS = {0: 'deep', 1: 'light', 2: 'rem', 3: 'awake'}
+
+# channel: (response field, timestamp field, value field, array typecode)
+CHANNELS = {
+    'heart_rate': ('sleepHeartRate', 'startGMT', 'value', 'H'),
+    'spo2': ('wellnessEpochSpO2DataDTOList', 'epochTimestamp', 'spo2Reading', 'B'),
+    'respiration': ('wellnessEpochRespirationDataDTOList', 'startTimeGMT', 'respirationValue',
+                    'f'),
+}
+
+# series name: (metric name, help text)
+SERIES = {
+    'stage': ('sleep_stage_intraday',
+              'Sleep stage from this sample on: 0 deep, 1 light, 2 REM, 3 awake'),
+    'heart_rate': ('sleep_heart_rate_intraday', 'Heart rate samples during sleep'),
+    'spo2': ('sleep_spo2_intraday', 'Pulse ox (SpO2) samples during sleep, in %'),
+    'respiration': ('sleep_respiration_intraday',
+                    'Respiration rate samples during sleep, in breaths per minute'),
+}
+
+# little-endian on disk, whatever the host
+SWAP = sys.byteorder == 'big'
+
+
+@lru_cache(maxsize=64)
+def day_seconds(date):
+    return calendar.timegm(datetime.datetime.strptime(date, '%Y-%m-%d').timetuple())
+
+
+def millis(value):
+    '''
+    Milliseconds since epoch of a GMT timestamp garmin sends either as a
+    number or as '2018-10-18T02:05:00.0', without going through datetime
+    for every epoch
+    '''
+    if isinstance(value, (int, float)):
+        return int(value)
+    seconds = day_seconds(value[:10]) + int(value[11:13]) * 3600 + \
+        int(value[14:16]) * 60 + int(value[17:19])
+    return seconds * 1000
+
+
+class Timeline():
+    '''
+    One night as parallel arrays: the sleep level segments as offsets in
+    seconds from the start of sleep plus one level code each (offsets has
+    one more entry, the end of the last segment), and per channel the
+    sample offsets and values. A night of minute epochs is a few KB
+    instead of thousands of dicts.
+    '''
+    __slots__ = ('start', 'offsets', 'levels', 'channels')
+
+    def __init__(self, start):
+        self.start = start
+        self.offsets = array('i')
+        self.levels = array('b')
+        self.channels = {name: (array('i'), array(CHANNELS[name][3])) for name in CHANNELS}
+
+    def stage_seconds(self):
+        '''
+        Seconds per sleep level, {'deep': ..., 'light': ..., 'rem': ..., 'awake': ...}
+        '''
+        seconds = dict.fromkeys(LEVELS.values(), 0)
+        offsets = self.offsets
+        for index, level in enumerate(self.levels):
+            name = LEVELS.get(level)
+            if name is not None:
+                seconds[name] += offsets[index + 1] - offsets[index]
+        return seconds
+
+    def series(self):
+        '''
+        Yield (series name, timestamps in ms, values) for a SampleBatch.
+        The stage series has a sample at the start of every segment and at
+        the end of the last one.
+        '''
+        if self.levels:
+            levels = array('d', self.levels)
+            levels.append(self.levels[-1])
+            yield 'stage', self.timestamps(self.offsets), levels
+        for name, (offsets, values) in self.channels.items():
+            if offsets:
+                yield name, self.timestamps(offsets), values
+
+    def timestamps(self, offsets):
+        start = self.start
+        return array('q', (start + offset * 1000 for offset in offsets))
+
+    def columns(self):
+        yield self.offsets
+        yield self.levels
+        for name in CHANNELS:
+            yield from self.channels[name]
+
+    def pack(self):
+        '''
+        The arrays as one blob: per column its length, then its items
+        '''
+        parts = []
+        for column in self.columns():
+            if SWAP:
+                column = array(column.typecode, column)
+                column.byteswap()
+            parts.append(struct.pack('<I', len(column)))
+            parts.append(column.tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def unpack(cls, start, blob):
+        timeline = cls(start)
+        position = 0
+        for column in timeline.columns():
+            count, = struct.unpack_from('<I', blob, position)
+            position += 4
+            size = count * column.itemsize
+            column.frombytes(blob[position:position + size])
+            position += size
+            if SWAP:
+                column.byteswap()
+        return timeline
+
+
+def parse_timeline(data):
+    '''
+    Timeline of a daily sleep response, see GarminConnect.get_sleep_data,
+    or None without sleep. The epochs go straight into the arrays.
+    '''
+    daily = data.get('dailySleepDTO') or {}
+    levels = data.get('sleepLevels') or ()
+    start = daily.get('sleepStartTimestampGMT')
+    if start is None and levels:
+        start = millis(levels[0]['startGMT'])
+    if start is None:
+        return None
+    timeline = Timeline(int(start))
+    base = timeline.start // 1000
+    offsets, codes = timeline.offsets, timeline.levels
+    end = None
+    for segment in levels:
+        segment_start = millis(segment['startGMT']) // 1000 - base
+        if end is not None and segment_start != end:
+            # a gap garmin left out, counted as awake
+            offsets.append(end)
+            codes.append(3)
+        offsets.append(segment_start)
+        codes.append(int(segment['activityLevel']))
+        end = millis(segment['endGMT']) // 1000 - base
+    if end is not None:
+        offsets.append(end)
+    for name, (field, time_key, value_key, typecode) in CHANNELS.items():
+        offsets, values = timeline.channels[name]
+        convert = float if typecode == 'f' else int
+        for epoch in data.get(field) or ():
+            value = epoch.get(value_key)
+            # negative values mean not measured
+            if value is None or value < 0:
+                continue
+            offsets.append(millis(epoch[time_key]) // 1000 - base)
+            values.append(convert(value))
+    return timeline
+
+
+class SleepTimelines():
+    '''
+    The sleep stage timeline, heart rate, SpO2 and respiration of every
+    night, taken from the same daily sleep request as the totals once garmin
+    confirmed the night (sleepWindowConfirmed), so each night is ingested
+    exactly once. Nights are archived as packed arrays, which keeps a year
+    of them cheap to load and aggregate again, and written as timestamped
+    series to the sinks that keep timestamps, or to an OpenMetrics file in
+    INTRADAY_OUTPUT without one, like the intraday series.
+    '''
+    def __init__(self, logger, archive, sinks=()):
+        self.logger = logger
+        self.archive = archive
+        self.enabled = os.environ.get('SLEEP_TIMELINE', 'false').lower() == 'true'
+        self.output_dir = os.environ.get('INTRADAY_OUTPUT')
+        self.sinks = [sink for sink in sinks if sink.timestamps]
+        self.lock = threading.Lock()
+        self.parsed = []
+
+    def fetch(self, connect):
+        '''
+        get_sleep for the fetcher: returns the daily totals and keeps the
+        timeline of a confirmed night that was not ingested yet. The
+        response is dropped once parsed.
+        '''
+        data = connect.get_sleep_data()
+        if data is None:
+            return None
+        daily = data.get('dailySleepDTO') or {}
+        user = connect.display_name
+        date = daily.get('calendarDate')
+        if daily.get('sleepWindowConfirmed') and date and \
+                not self.archive.has_timeline(user, date):
+            timeline = parse_timeline(data)
+            if timeline is not None:
+                with self.lock:
+                    self.parsed.append((user, date, timeline))
+        return daily
+
+    def nights(self, user, start=None, end=None):
+        '''
+        [(date, Timeline)] of the archived nights of a user, oldest first
+        '''
+        return [(date, Timeline.unpack(night_start, blob))
+                for _, date, night_start, blob in self.archive.timelines(user, start, end)]
+
+    def flush(self):
+        '''
+        Archive the nights parsed this run, then write every archived night
+        not written yet, including those a failed write left behind. With
+        no sink that keeps timestamps and no INTRADAY_OUTPUT the nights wait
+        in the archive.
+        '''
+        with self.lock:
+            parsed, self.parsed = self.parsed, []
+        for user, date, timeline in parsed:
+            self.archive.timeline(user, date, timeline.start, timeline.pack())
+        if not self.sinks and not self.output_dir:
+            return None
+        rows = self.archive.timelines(delivered=False)
+        if not rows:
+            return None
+        batch = SampleBatch()
+        for user, date, start, blob in rows:
+            for name, timestamps, values in Timeline.unpack(start, blob).series():
+                metric, documentation = SERIES[name]
+                batch.add_series(metric, documentation, 'gauge', {'user': user},
+                                 timestamps, values)
+        if self.sinks:
+            path = ', '.join(sink.url for sink in self.sinks)
+            for sink in self.sinks:
+                sink.write({'source': 'sleep_timeline'}, batch)
+        else:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, 'sleep-{}.om'.format(
+                datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+            write_openmetrics(path, batch)
+        self.archive.delivered_timelines([(user, date) for user, date, _, _ in rows])
+        self.logger.info('Wrote the sleep timelines of {} nights to {}'.format(len(rows), path))
+        return path
@@ -0,0 +1,51 @@
+import importlib
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+# as close to process start as we get without reading /proc, collector.py
+# imports this module first
+started = time.monotonic()
+
+lock = threading.Lock()
+import_times = OrderedDict()
+marks = OrderedDict()
+
+
+def lazy_import(name):
+    '''
+    Import a heavy module on first use instead of at startup and remember
+    how long the import took, for the startup report.
+    '''
+    with lock:
+        loaded = name in sys.modules
+        start = time.monotonic()
+        # import_module, not sys.modules: it waits for a module that another
+        # thread is still importing
+        module = importlib.import_module(name)
+        if not loaded:
+            import_times.setdefault(name, time.monotonic() - start)
+    return module
+
+
+def mark(event):
+    '''
+    Record the first time `event` happens, in seconds since startup.
+    '''
+    if event in marks:
+        return
+    with lock:
+        marks.setdefault(event, time.monotonic() - started)
+
+
+def report():
+    lines = ['Startup report (seconds since start):']
+    for event, elapsed in marks.items():
+        lines.append('  {:<28} {:8.3f}'.format(event, elapsed))
+    if import_times:
+        lines.append('Lazy imports (seconds):')
+        for name, elapsed in import_times.items():
+            lines.append('  {:<28} {:8.3f}'.format(name, elapsed))
+    return '\n'.join(lines)
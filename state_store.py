@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+import threading
+
+
+def state_dir():
+    path = os.path.expanduser(os.environ.get('STATE_DIR', '~/.healthstats'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def state_path(name):
+    return os.path.join(state_dir(), name)
+
+
+def load_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data, mode=0o644):
+    # write to a temp file in the same directory and rename it over the
+    # target, so a crash mid-write never leaves a truncated state file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class StateStore():
+    '''
+    Small json backed key/value store for state that has to survive
+    between runs, saved atomically with save()
+    '''
+    def __init__(self, name='state.json'):
+        self.path = state_path(name)
+        self.lock = threading.RLock()
+        self.data = load_json(self.path, {})
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def keys(self, prefix=''):
+        with self.lock:
+            return [key for key in self.data if key.startswith(prefix)]
+
+    def save(self):
+        with self.lock:
+            save_json(self.path, self.data)
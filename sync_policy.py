@@ -0,0 +1,117 @@
+import datetime
+import os
+import time
+
+from collections import namedtuple
+
+from startup import lazy_import
+
+# interval: seconds between two downloads, 0 for every run
+# hours: local hours of the day (start, end) downloads are worth it in
+# final_key: payload field that is true once the day's data is final, no
+#   more downloads of that day after it
+# backoff: upper bound, in seconds, of the interval doubling for every
+#   download in a row that brought nothing new, 0 for no backoff
+SyncPolicy = namedtuple(
+    'SyncPolicy', ['interval', 'hours', 'final_key', 'backoff'],
+    defaults=[0, (0, 24), None, 0])
+
+POLICIES = {
+    # changes with every watch sync during the day
+    'summary': SyncPolicy(backoff=2 * 3600),
+    # a few weigh-ins a week at most
+    'weight': SyncPolicy(interval=3600, backoff=6 * 3600),
+    # last night's sleep is only worth it in the afternoon, when it is
+    # complete, and only until garmin confirmed it
+    'sleep': SyncPolicy(hours=(12, 24), final_key='sleepWindowConfirmed',
+                        backoff=4 * 3600),
+    'activities': SyncPolicy(backoff=2 * 3600),
+}
+
+# runs start a little late, or early, don't skip one for that
+SLACK = 120
+
+
+class SyncPlanner():
+    '''
+    Decides per data source and account whether a download can bring
+    anything new, from the source's SyncPolicy and the persisted state of
+    its last download: when it was, for which local date, whether it
+    changed and whether the day was final. Sources without a policy are
+    downloaded every run.
+
+    State per source and user:
+    {"date": "2019-01-28", "fetched_at": 1548695197.1, "fingerprint": "...", "unchanged": 2, "final": false}
+    '''
+    def __init__(self, logger, store, fingerprint):
+        self.logger = logger
+        self.store = store
+        self.fingerprint = fingerprint
+        self.timezone = os.environ.get('TIMEZONE', 'UTC')
+        # backoff doubles from one run interval
+        self.run_interval = int(os.environ.get('COLLECT_INTERVAL', '3600'))
+        self.skipped = []
+        self.recorded = set()
+
+    def key(self, source, user):
+        return 'sync:{}:{}'.format(source, user)
+
+    def local_now(self):
+        return lazy_import('pytz').timezone(self.timezone).fromutc(datetime.datetime.utcnow())
+
+    def due(self, source, user, known=True):
+        '''
+        Whether to download a source of a user this run. With known False
+        the values of the last download are not around anymore (a
+        restarted server), so only the time of day is taken into account.
+        '''
+        policy = POLICIES.get(source)
+        if policy is None:
+            return True
+        now = self.local_now()
+        start, end = policy.hours
+        if not start <= now.hour < end:
+            return self.skip(source, user, 'outside {:02d}:00-{:02d}:00'.format(start, end))
+        last = self.store.get(self.key(source, user))
+        if not known or not last or last['date'] != now.strftime('%Y-%m-%d'):
+            # a new day always starts over
+            return True
+        if last['final']:
+            return self.skip(source, user, 'final for today')
+        wait = policy.interval
+        if policy.backoff and last['unchanged']:
+            base = max(policy.interval, self.run_interval)
+            wait = min(base * 2 ** (last['unchanged'] - 1), policy.backoff)
+        if time.time() + SLACK < last['fetched_at'] + wait:
+            return self.skip(source, user, 'downloaded {} minutes ago, unchanged {} times'.format(
+                int(time.time() - last['fetched_at']) // 60, last['unchanged']))
+        return True
+
+    def skip(self, source, user, reason):
+        self.logger.info('Skipping {} of {}: {}'.format(source, user, reason))
+        self.skipped.append((source, user))
+        return False
+
+    def record(self, source, user, data):
+        '''
+        Remember a download. Empty payloads are failed downloads, they
+        are tried again next run.
+        '''
+        policy = POLICIES.get(source)
+        if policy is None or not data:
+            return
+        key = self.key(source, user)
+        date = self.local_now().strftime('%Y-%m-%d')
+        fingerprint = self.fingerprint(source, data)
+        last = self.store.get(key) or {}
+        unchanged = 0
+        if last.get('date') == date and last.get('fingerprint') == fingerprint:
+            unchanged = last['unchanged'] + 1
+        self.store.set(key, {
+            'date': date,
+            'fetched_at': time.time(),
+            'fingerprint': fingerprint,
+            'unchanged': unchanged,
+            'final': bool(policy.final_key and isinstance(data, dict) and data.get(policy.final_key)),
+        })
+        self.recorded.add((source, user))
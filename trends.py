@@ -0,0 +1,171 @@
+import datetime
+import math
+import os
+
+from metric_specs import GRAMS, TREND_WINDOWS, TRENDS
+from startup import lazy_import
+
+# trend: (metric group, payload field, scale)
+SOURCES = {
+    'resting_heart_rate': ('summary', 'restingHeartRate', 1),
+    'steps': ('summary', 'totalSteps', 1),
+    'sleep': ('sleep', 'sleepTimeSeconds', 1),
+    'weight': ('weight', 'weight', GRAMS),
+}
+
+BASELINE = 28
+# time constants, in days, of the exponentially weighted training loads
+LOADS = {'acute': 7, 'chronic': 28}
+
+
+def day_number(date):
+    return datetime.datetime.strptime(date, '%Y-%m-%d').toordinal()
+
+
+def new_series():
+    # values: one per day, oldest first, None for days without one.
+    # sums: per window, the sum, sum of squares and count of its values
+    return {'date': None, 'values': [],
+            'sums': {str(window): [0.0, 0.0, 0] for window in TREND_WINDOWS}}
+
+
+def adjust(sums, value, sign):
+    if value is not None:
+        sums[0] += sign * value
+        sums[1] += sign * value * value
+        sums[2] += sign
+
+
+def record(series, date, value):
+    '''
+    Put the value of a date into a series: a newer date moves the windows
+    forward one day per day passed, an earlier date still in the longest
+    window replaces what was recorded for it. Either way the running sums
+    of each window are adjusted, not recomputed.
+    '''
+    values = series['values']
+    day = day_number(date)
+    last = day_number(series['date']) if series['date'] else day - 1
+    if day <= last:
+        index = len(values) - 1 - (last - day)
+        if index < 0:
+            return False
+        for window, sums in series['sums'].items():
+            if last - day < int(window):
+                adjust(sums, values[index], -1)
+                adjust(sums, value, 1)
+        values[index] = value
+        return True
+    longest = max(TREND_WINDOWS)
+    for step in range(min(day - last, longest), 0, -1):
+        values.append(value if step == 1 else None)
+        for window, sums in series['sums'].items():
+            adjust(sums, values[-1], 1)
+            if len(values) > int(window):
+                # the value that just left the window
+                adjust(sums, values[-int(window) - 1], -1)
+        del values[:-longest]
+    series['date'] = date
+    return True
+
+
+class Trends():
+    '''
+    Derived daily series kept up to date from a small persisted state
+    instead of PromQL over long ranges: 7, 28 and 90 day averages of
+    resting heart rate, steps, sleep and weight, the deviation of their
+    latest value from the 28 day baseline, and the exponentially weighted
+    acute (7 day) and chronic (28 day) training load from intensity
+    minutes. A new daily value costs the same however long the windows.
+    '''
+    def __init__(self, logger, store):
+        self.logger = logger
+        self.store = store
+        self.timezone = os.environ.get('TIMEZONE', 'UTC')
+        self.updated = set()
+
+    def key(self, user):
+        return 'trends:{}'.format(user)
+
+    def update(self, group, user, date, data):
+        '''
+        Record the values a group's payload holds for the trends
+        '''
+        state = self.store.get(self.key(user)) or {}
+        if group == 'weight' and data.get('date'):
+            # the day of the weigh-in, not the day it was downloaded
+            utc = datetime.datetime.utcfromtimestamp(data['date'] / 1000.0)
+            date = lazy_import('pytz').timezone(self.timezone).fromutc(utc).strftime('%Y-%m-%d')
+        changed = False
+        for trend, (source, field, scale) in SOURCES.items():
+            value = data.get(field)
+            if source != group or value is None:
+                continue
+            series = state.setdefault(trend, new_series())
+            changed = record(series, date, value * scale) or changed
+        if group == 'summary':
+            moderate = data.get('moderateIntensityMinutes')
+            vigorous = data.get('vigorousIntensityMinutes')
+            if moderate is not None or vigorous is not None:
+                # vigorous minutes count double, like garmin's weekly goal
+                load = (moderate or 0) + 2 * (vigorous or 0)
+                changed = self.load(state, date, load) or changed
+        if changed:
+            self.store.set(self.key(user), state)
+            self.updated.add(user)
+
+    def load(self, state, date, load):
+        '''
+        Exponentially weighted moving averages of the daily load. The state
+        keeps the averages up to the day before the latest date, so that
+        day's load can still be replaced by a later download.
+        '''
+        loads = state.setdefault('load', {'date': None, 'load': 0.0,
+                                          'before': {name: 0.0 for name in LOADS}})
+        day = day_number(date)
+        if loads['date'] is not None:
+            last = day_number(loads['date'])
+            if day < last:
+                return False
+            if day > last:
+                for name, days in LOADS.items():
+                    alpha = 2.0 / (days + 1)
+                    current = loads['before'][name] * (1 - alpha) + alpha * loads['load']
+                    # the days in between had no load
+                    loads['before'][name] = current * (1 - alpha) ** (day - last - 1)
+        loads['date'] = date
+        loads['load'] = load
+        return True
+
+    def values(self, user):
+        '''
+        Current trend values of a user, keyed like the TREND metric specs
+        '''
+        state = self.store.get(self.key(user)) or {}
+        result = {}
+        for trend in TRENDS:
+            series = state.get(trend)
+            if not series:
+                continue
+            for window, (total, squares, count) in series['sums'].items():
+                if count > 0:
+                    result['{}:{}d'.format(trend, window)] = total / count
+            latest = next((value for value in reversed(series['values'])
+                           if value is not None), None)
+            total, squares, count = series['sums'][str(BASELINE)]
+            if latest is None or count < 2:
+                continue
+            mean = total / count
+            result['{}:deviation'.format(trend)] = latest - mean
+            variance = max(squares / count - mean * mean, 0.0)
+            if variance > 0:
+                result['{}:zscore'.format(trend)] = (latest - mean) / math.sqrt(variance)
+        loads = state.get('load')
+        if loads and loads['date'] is not None:
+            for name, days in LOADS.items():
+                alpha = 2.0 / (days + 1)
+                result['load:' + name] = \
+                    loads['before'][name] * (1 - alpha) + alpha * loads['load']
+            if result['load:chronic'] > 0:
+                result['load:ratio'] = result['load:acute'] / result['load:chronic']
+        return result